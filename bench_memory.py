@@ -0,0 +1,82 @@
+import argparse
+import gc
+import random
+import tracemalloc
+
+from formal_reasoning import Task, Truth, TaskTable
+
+
+class LegacyTask:
+    # the task representation before slots / frozen evidential bases, kept only for comparison
+
+    def __init__(self, sub, obj, copula, truth, eb, rl=None):
+        self.sub = sub
+        self.obj = obj
+        self.copula = copula
+        self.truth = truth
+        self.f = truth.f
+        self.c = truth.c
+        self.eb = eb
+        self.r = rl
+
+
+class LegacyTruth:
+
+    def __init__(self, f=1., c=0.9):
+        self.f = f
+        self.c = c
+
+
+def gen_fields(n, num_terms):
+    # terms are built per task (like in data generation), so nothing is shared unless interned
+    ret = []
+    for _ in range(n):
+        sub, obj = random.sample(range(num_terms), 2)
+        eb = {random.randint(0, 10000) for _ in range(random.randint(1, 4))}
+        ret.append((f"ID_{sub}", f"ID_{obj}", random.choice(["-->", "<->"]), random.random(), random.random(), eb,
+                    random.choice(["ded", "abd", "com_p"])))
+    return ret
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    tmp = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tmp
+    return current
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--num_tasks", type=int, default=200000, help="Number of tasks to store")
+    parser.add_argument("--num_terms", type=int, default=100000, help="Number of distinct terms")
+    parser.add_argument("--random_seed", type=int, default=39, help="Random seed")
+
+    args = parser.parse_args()
+
+    random.seed(args.random_seed)
+
+    legacy = measure(lambda: [LegacyTask(each[0], each[1], each[2], LegacyTruth(each[3], each[4]), set(each[5]),
+                                         each[6])
+                              for each in gen_fields(args.num_tasks, args.num_terms)])
+    random.seed(args.random_seed)
+    slotted = measure(lambda: [Task(each[0], each[1], each[2], Truth(each[3], each[4]), each[5], each[6])
+                               for each in gen_fields(args.num_tasks, args.num_terms)])
+
+    def build_table():
+        table = TaskTable()
+        for each in gen_fields(args.num_tasks, args.num_terms):
+            table.append(Task(each[0], each[1], each[2], Truth(each[3], each[4]), each[5], each[6]))
+        return table
+
+    random.seed(args.random_seed)
+    columnar = measure(build_table)
+
+    print(f">- {args.num_tasks} tasks")
+    for name, size in [("legacy", legacy), ("slotted", slotted), ("columnar", columnar)]:
+        print(f"{name:>10}: {size / 2 ** 20:8.2f} MiB, {size / args.num_tasks:7.1f} B/task, "
+              f"{legacy / size:5.2f}x")
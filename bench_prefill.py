@@ -0,0 +1,92 @@
+import argparse
+import copy
+import time
+
+import pandas as pd
+import torch
+
+from inference import (TOKENIZER_LENGTH, answer_cap, common_prefix_length, get_full_text, get_full_text_test,
+                       pad_after_prefix, prefix_cache, token_budget_batches)
+from tiny_model import EOS_TOKEN, tiny_model, tiny_tokenizer
+
+# prefill (encoding of the prompts before the generation) of the test prompts by a tiny model on cpu, with the kv
+# cache of the shared introduction reused or without it
+
+
+def prefill(model, inputs, cache=None):
+    # logits of the last token of each prompt
+    with torch.no_grad():
+        if cache is None:
+            return model(**inputs).logits[:, -1]
+        # the positions follow the attention mask (skipping the padding after the prefix), as in model.generate
+        prefix_length = cache.get_seq_length()
+        position_ids = (inputs["attention_mask"].cumsum(-1) - 1).clamp(min=0)[:, prefix_length:]
+        return model(input_ids=inputs["input_ids"][:, prefix_length:], attention_mask=inputs["attention_mask"],
+                     position_ids=position_ids, past_key_values=cache).logits[:, -1]
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, ret
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--test_path", type=str, default="./data/data_table_test.csv")
+    parser.add_argument("--num_test", type=int, default=64)
+    parser.add_argument("--max_tokens", type=int, default=16 * TOKENIZER_LENGTH)
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--num_layers", type=int, default=4)
+    parser.add_argument("--answer_cap", action="store_true", help="Budget the batches as run_test with --answer_cap")
+    parser.add_argument("--repeat", type=int, default=3, help="Best time of the repetitions")
+
+    args = parser.parse_args()
+
+    rows = pd.read_csv(args.test_path, quotechar='"', doublequote=True)[:args.num_test].to_dict("records")
+    tokenizer = tiny_tokenizer([get_full_text(each, EOS_TOKEN) for each in rows])
+    model = tiny_model(tokenizer, hidden_size=args.hidden_size, num_layers=args.num_layers)
+    model.eval()
+
+    input_ids = tokenizer([get_full_text_test(each) for each in rows], truncation=True,
+                          max_length=TOKENIZER_LENGTH)["input_ids"]
+    prefix_length = common_prefix_length(input_ids)
+    # the batches of the generation (run_test)
+    batches = token_budget_batches([len(each) for each in input_ids], args.max_tokens,
+                                   max_new_tokens=answer_cap(tokenizer, rows) if args.answer_cap else None)
+
+    # the prefix is encoded once for all the batches
+    prefix_time, cache = timed(lambda: prefix_cache(model, input_ids[0][:prefix_length]), args.repeat)
+
+    full_time, reuse_time, full_tokens, reuse_tokens, difference = 0., prefix_time, 0, prefix_length, 0.
+    padding_side, tokenizer.padding_side = tokenizer.padding_side, "left"
+    for batch in batches:
+        prompts = [input_ids[i] for i in batch]
+        inputs = tokenizer.pad({"input_ids": prompts}, return_tensors="pt")
+        elapsed, full = timed(lambda: prefill(model, inputs), args.repeat)
+        full_time += elapsed
+        full_tokens += inputs["input_ids"].numel()
+
+        def reuse():
+            batch_cache = copy.deepcopy(cache)
+            batch_cache.batch_repeat_interleave(len(batch))
+            return prefill(model, shared, batch_cache)
+
+        shared = pad_after_prefix(prompts, prefix_length, tokenizer.pad_token_id)
+        elapsed, reused = timed(reuse, args.repeat)
+        reuse_time += elapsed
+        reuse_tokens += shared["input_ids"].numel() - len(batch) * prefix_length
+        difference = max(difference, (full - reused).abs().max().item())
+    tokenizer.padding_side = padding_side
+
+    print(f">- {len(rows)} prompts in {len(batches)} batches, shared prefix of {prefix_length} tokens "
+          f"(prompts of {min(map(len, input_ids))} to {max(map(len, input_ids))} tokens)")
+    print(f">- without reuse: {full_time:.3f} s, {full_tokens} tokens encoded")
+    print(f">- with reuse: {reuse_time:.3f} s ({prefix_time:.3f} s for the prefix), {reuse_tokens} tokens encoded")
+    print(f">- speedup: {full_time / reuse_time:.2f}x, max difference of the last logits: {difference:.2e}")
@@ -0,0 +1,203 @@
+from collections import defaultdict
+
+import torch
+from transformers import LogitsProcessor
+
+from formal_reasoning import TaskTable, TruthFunctions
+
+# constrained decoding of the answers, {"step 1": step, "step 2": step} where a step is
+# {"premise_1": task, "premise_2": task, "results": [task, ...]} and a task is
+# {"s": term, "o": term, "cp": copula, "f": value, "c": value, "eb": [int, ...], "r": rule}, as formatted by json.dumps
+# and Task.to_json (the terms are "ID_<int>", the values have at most 3 decimals, "r" is optional in the premises)
+# the answers are a finite language, recognized by a character level automaton, the tokens allowed in each of its
+# states (and the states they lead to) are computed once per tokenizer, by walking the automaton over the tokens
+
+
+class AnswerAutomaton:
+
+    def __init__(self, copulas=None, rules=None, max_eb=8, max_results=1):
+        self.copulas = copulas or [each for each in TaskTable.copulas]
+        self.rules = rules or list(TruthFunctions().tf)
+        self.max_eb = max_eb
+        self.max_results = max_results
+
+        self.trans = []  # state -> {char: state}
+        self.start = self.new()
+        self.final = self.answer({self.start}).pop()
+
+    def new(self):
+        self.trans.append({})
+        return len(self.trans) - 1
+
+    def step(self, state, ch):
+        return self.trans[state].get(ch)
+
+    def alternatives(self, states, texts, end=None):
+        # the texts from each of the states, all ending in the same state (returned in a set)
+        end = self.new() if end is None else end
+        groups = defaultdict(list)
+        for each in texts:
+            groups[each[0]].append(each[1:])
+        for ch, rests in groups.items():
+            assert all(rests) or not any(rests), "a text is a prefix of another"
+            target = end if not rests[0] else self.new()
+            for each in states:
+                assert ch not in self.trans[each], "ambiguous transition"
+                self.trans[each][ch] = target
+            if rests[0]:
+                self.alternatives({target}, rests, end)
+        return {end}
+
+    def literal(self, states, text, end=None):
+        return self.alternatives(states, [text], end)
+
+    def digits(self, states, minimum, maximum):
+        # the states after minimum to maximum digits
+        ret = set()
+        for i in range(maximum):
+            target = self.new()
+            for each in states:
+                for ch in "0123456789":
+                    self.trans[each][ch] = target
+            states = {target}
+            if i + 1 >= minimum:
+                ret.add(target)
+        return ret
+
+    def value(self, states):
+        return self.digits(self.alternatives(states, ["0.", "1."]), 1, 3)
+
+    def term(self, states):
+        return self.literal(self.digits(self.literal(states, '"ID_'), 1, 5), '"')
+
+    def task(self, states, rule):
+        # rule is "required" or "optional"
+        states = self.term(self.literal(states, '{"s": '))
+        states = self.term(self.literal(states, ', "o": '))
+        states = self.alternatives(self.literal(states, ', "cp": '), [f'"{each}"' for each in self.copulas])
+        states = self.value(self.literal(states, ', "f": '))
+        states = self.value(self.literal(states, ', "c": '))
+
+        states = self.literal(states, ', "eb": [')
+        end = self.new()
+        for i in range(self.max_eb):
+            states = self.digits(states, 1, 5)
+            self.literal(states, "]", end)
+            if i + 1 < self.max_eb:
+                states = self.literal(states, ", ")
+        states = {end}
+
+        ret = self.new()
+        if rule == "optional":
+            self.literal(states, "}", ret)
+        states = self.alternatives(self.literal(states, ', "r": '), [f'"{each}"' for each in self.rules])
+        return self.literal(states, "}", ret)
+
+    def reasoning_step(self, states):
+        states = self.task(self.literal(states, '{"premise_1": '), "optional")
+        states = self.task(self.literal(states, ', "premise_2": '), "optional")
+        states = self.literal(states, ', "results": [')
+        end = self.new()
+        for i in range(self.max_results):
+            states = self.task(states, "required")
+            self.literal(states, "]}", end)
+            if i + 1 < self.max_results:
+                states = self.literal(states, ", ")
+        return {end}
+
+    def answer(self, states):
+        # the answer follows "Assistant:" after a space
+        states = self.reasoning_step(self.literal(states, ' {"step 1": '))
+        states = self.reasoning_step(self.literal(states, ', "step 2": '))
+        return self.literal(states, "}")
+
+
+class AnswerConstraint:
+    # the automaton over the tokens of a tokenizer, the eos token is only allowed (and required) at the end
+
+    def __init__(self, tokenizer, automaton=None):
+        self.automaton = automaton or AnswerAutomaton()
+        self.vocab_size = len(tokenizer)
+        self.eos_token_id = tokenizer.eos_token_id
+
+        special = set(tokenizer.all_special_ids)
+        self.by_first = defaultdict(list)  # first char -> [(token id, text), ...]
+        for token_id in range(self.vocab_size):
+            if token_id in special:
+                continue
+            text = tokenizer.decode([token_id])
+            if text and "\ufffd" not in text:
+                self.by_first[text[0]].append((token_id, text))
+
+        self.tables = {}  # state -> ({token id: state}, allowed token ids)
+        self.masks = {}  # (state, width, device) -> mask of the tokens which are not allowed
+
+    def walk(self, state, text):
+        for ch in text:
+            state = self.automaton.step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def table(self, state):
+        ret = self.tables.get(state)
+        if ret is None:
+            transitions = {}
+            if state == self.automaton.final:
+                transitions[self.eos_token_id] = None
+            for ch in self.automaton.trans[state]:
+                for token_id, text in self.by_first[ch]:
+                    target = self.walk(state, text)
+                    if target is not None:
+                        transitions[token_id] = target
+            if not transitions:  # no token of the tokenizer continues the answer, it is ended instead
+                transitions[self.eos_token_id] = None
+            ret = self.tables[state] = (transitions, torch.tensor(sorted(transitions), dtype=torch.long))
+        return ret
+
+    def mask(self, state, width, device):
+        # bool tensor of the tokens which are not allowed in the state (none for None, a finished sequence), over the
+        # width of the scores (the embeddings of some models have more rows than the tokenizer), cached on the device
+        key = (state, width, str(device))
+        ret = self.masks.get(key)
+        if ret is None:
+            ret = torch.zeros(width, dtype=torch.bool)
+            if state is not None:
+                ret[:] = True
+                ret[self.table(state)[1]] = False
+            ret = self.masks[key] = ret.to(device)
+        return ret
+
+    def precompute(self):
+        # the tables of all the states
+        for state in range(len(self.automaton.trans)):
+            self.table(state)
+        return self
+
+    def next_state(self, state, token_id):
+        # None after the eos token or a token which is not allowed
+        return self.table(state)[0].get(token_id)
+
+
+class AnswerLogitsProcessor(LogitsProcessor):
+    # only the tokens continuing an answer of the schema are allowed, the state of each sequence is updated
+    # incrementally from the tokens generated after the (padded) prompt
+
+    def __init__(self, constraint: AnswerConstraint, prompt_length):
+        self.constraint = constraint
+        self.position = prompt_length
+        self.states = None
+
+    def __call__(self, input_ids, scores):
+        if self.states is None:
+            self.states = [self.constraint.automaton.start] * input_ids.shape[0]
+
+        for position in range(self.position, input_ids.shape[1]):
+            for row, token_id in enumerate(input_ids[:, position].tolist()):
+                if self.states[row] is not None:
+                    self.states[row] = self.constraint.next_state(self.states[row], token_id)
+        self.position = input_ids.shape[1]
+
+        # the finished sequences (then padded) are not constrained
+        mask = torch.stack([self.constraint.mask(each, scores.shape[-1], scores.device) for each in self.states])
+        return scores.masked_fill_(mask, -float("inf"))
@@ -0,0 +1,148 @@
+import argparse
+import gc
+import os
+
+import pandas as pd
+import torch
+from transformers import Trainer, TrainingArguments, set_seed
+
+from inference import TOKENIZER_LENGTH, get_full_text, run_test
+from preprocessing import packed_collator, packed_dataset
+from streaming import ReasoningStream
+
+# the cycles of rLLMFT.ipynb (fine-tuning the base model on data_table_{i}_{num_models}.csv, then testing it) for all
+# the model indices in a single process, the base weights are loaded once and restored from a copy in memory before
+# each cycle, the trainer (and its optimizer states) is released after each of them
+# with --stream_steps, the training samples are generated on the fly (streaming.py) instead of read from the tables
+
+
+def weights_copy(model):
+    # copy of the weights on cpu
+    return {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+
+
+def release_memory(device):
+    gc.collect()
+    if device.startswith("cuda"):
+        torch.cuda.empty_cache()
+
+
+def finetune(model, dataset, args):
+    training_args = TrainingArguments(
+        output_dir=args.finetune_dir,
+        per_device_train_batch_size=args.batch_size,
+        num_train_epochs=args.num_epochs,
+        max_steps=args.stream_steps or -1,
+        dataloader_num_workers=args.num_workers,
+        logging_steps=args.logging_steps,
+        save_strategy="no",
+        bf16=not args.no_bf16,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        seed=args.random_seed,
+        use_cpu=args.device == "cpu",
+        report_to=[])
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        data_collator=packed_collator(model),  # with use_cache=False, and a block causal mask if needed
+        train_dataset=dataset)
+
+    try:
+        trainer.train()
+    finally:
+        del trainer
+
+
+def data_path(data_dir, model_index, num_models):
+    return os.path.join(data_dir, f"data_table_{model_index}_{num_models}.csv")
+
+
+def read_table(path):
+    return pd.read_csv(path, quotechar='"', doublequote=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model_name", type=str, default="Qwen/Qwen2.5-1.5B", help="Name or path of the base model")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized model on cpu instead")
+    parser.add_argument("--num_models", type=int, default=3, help="Number of LLM models used (as in data_gen.py)")
+    parser.add_argument("--model_indices", type=int, nargs="*", default=None,
+                        help="Indices of the models to fine-tune and test, all of them by default")
+    parser.add_argument("--skip_existing", action="store_true",
+                        help="Skip the models whose test record is already written (to resume an interrupted job)")
+    parser.add_argument("--data_dir", type=str, default="./data")
+    parser.add_argument("--output_dir", type=str, default="./test_record")
+    parser.add_argument("--finetune_dir", type=str, default="./finetuned_model")
+    parser.add_argument("--num_epochs", type=float, default=2)
+    parser.add_argument("--batch_size", type=int, default=1, help="Packed sequences per device and step")
+    parser.add_argument("--gradient_accumulation_steps", type=int, default=4)
+    parser.add_argument("--logging_steps", type=int, default=10)
+    parser.add_argument("--pack_length", type=int, default=TOKENIZER_LENGTH)
+    parser.add_argument("--no_bf16", action="store_true",
+                        help="Train in full precision instead of bf16 mixed precision (as in rLLMFT.ipynb)")
+    parser.add_argument("--stream_steps", type=int, default=None,
+                        help="Train for this number of steps on samples generated on the fly, instead of the tables")
+    parser.add_argument("--num_workers", type=int, default=0, help="Dataloader worker processes")
+    parser.add_argument("--num_templates", type=int, default=10, help="Number of templates to use, when streaming")
+    parser.add_argument("--num_categories", type=int, default=5, help="Number of categories to use, when streaming")
+    parser.add_argument("--num_test", type=int, default=None, help="Number of test prompts, all of them by default")
+    parser.add_argument("--max_tokens", type=int, default=16 * TOKENIZER_LENGTH,
+                        help="Token budget of each generation batch")
+    parser.add_argument("--max_new_tokens", type=int, default=None,
+                        help="Maximum number of generated tokens, up to the length limit by default")
+    parser.add_argument("--answer_cap", action="store_true",
+                        help="Without --max_new_tokens, cap the generated tokens at 1.25 times the longest answer of "
+                             "the test table, to budget the batches with it")
+    parser.add_argument("--random_seed", type=int, default=39, help="Random seed")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    args = parser.parse_args()
+
+    model_indices = args.model_indices if args.model_indices else list(range(args.num_models))
+    test_path = os.path.join(args.data_dir, "data_table_test.csv")
+
+    if args.tiny:  # the tokenizer is trained on all the tables
+        from tiny_model import EOS_TOKEN, tiny_model, tiny_tokenizer
+        paths = [data_path(args.data_dir, i, args.num_models) for i in model_indices] + [test_path]
+        paths = [each for each in paths if os.path.exists(each)]
+        tokenizer = tiny_tokenizer([get_full_text(each, EOS_TOKEN) for path in paths
+                                    for each in read_table(path).to_dict("records")])
+        model = tiny_model(tokenizer, seed=args.random_seed, max_length=max(args.pack_length, TOKENIZER_LENGTH))
+    else:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        model = AutoModelForCausalLM.from_pretrained(args.model_name)
+    tokenizer.model_max_length = TOKENIZER_LENGTH
+    base_weights = weights_copy(model)
+
+    for model_index in model_indices:
+        record_path = os.path.join(args.output_dir, f"test_record_{model_index}_{args.num_models}.csv")
+        if args.skip_existing and os.path.exists(record_path):
+            print(f">- model {model_index}: {record_path} already written, skipped")
+            continue
+
+        print(f">- model {model_index}: fine-tuning")
+        set_seed(args.random_seed)
+        model.load_state_dict(base_weights)
+        if args.stream_steps:
+            dataset = ReasoningStream(tokenizer, model_index, args.num_models, random_seed=args.random_seed,
+                                      num_templates=args.num_templates, num_categories=args.num_categories,
+                                      max_length=TOKENIZER_LENGTH, pack_length=args.pack_length)
+        else:
+            dataset = packed_dataset(tokenizer, read_table(data_path(args.data_dir, model_index, args.num_models)),
+                                     max_length=TOKENIZER_LENGTH, pack_length=args.pack_length)
+        finetune(model, dataset, args)
+        del dataset
+        release_memory(args.device)
+
+        print(f">- model {model_index}: testing")
+        model.to(args.device)
+        print(run_test(model, tokenizer, model_index, args.num_models, test_path, args.output_dir, args.num_test,
+                       args.answer_cap, max_tokens=args.max_tokens, max_new_tokens=args.max_new_tokens,
+                       device=args.device))
+        release_memory(args.device)
+        if args.device.startswith("cuda"):
+            print(f">- peak gpu memory: {torch.cuda.max_memory_allocated() / 2 ** 30:.2f} GiB")
+            torch.cuda.reset_peak_memory_stats()
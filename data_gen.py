@@ -1,25 +1,476 @@
 import argparse
 import csv
+import glob
 import json
 import os
 import random
+import shutil
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
 
 from config import cs
 from formal_reasoning import (_inheritance_templates, _similarity_templates, _truth_categories,
-                              _inheritance_templates_q, _similarity_templates_q, Generator)
+                              _inheritance_templates_q, _similarity_templates_q, Generator, iter_indexed_reasoning)
+
+INTRODUCTION = ("A conversation between User and Assistant. The user provides the background knowledge and asks a "
+                "question. The Assistant needs to solve it showing logical reasoning steps. "
+                "**Only** derive the asked conclusion. Output the valid JSON string **directly**. ")
+PREMISE_TEMPLATE = "Suppose we have the premises: {premises} "
+QUESTION_TEMPLATE = "Could you please answer the question: {question}? "
+
+COLUMNS = ["Introduction", "Premise", "Question", "Answer"]
+FORMATS = ["csv", "jsonl", "arrow", "parquet"]
 
 
 def generate_raw_prompt(premises_str, question_str, results):
     return [
-        "A conversation between User and Assistant. The user provides the background knowledge and asks a question. "
-        "The Assistant needs to solve it showing logical reasoning steps. "
-        "**Only** derive the asked conclusion. Output the valid JSON string **directly**. ",
-        f"Suppose we have the premises: {' '.join(each for each in premises_str)} ",
-        f"Could you please answer the question: {question_str}? ",
+        INTRODUCTION,
+        PREMISE_TEMPLATE.format(premises=' '.join(each for each in premises_str)),
+        QUESTION_TEMPLATE.format(question=question_str),
         json.dumps({"step 1": results[0], "step 2": results[1]})
     ]
 
 
+def generate_record(premises_str, question_str, results):
+    # structured sample for the jsonl/arrow/parquet tables, the constant texts are kept in the metadata instead
+    return {"premises": list(premises_str), "question": question_str, "step 1": results[0], "step 2": results[1]}
+
+
+def raw_prompt_from_record(record):
+    # rebuild the csv row of a structured sample (the missing "r" of premises is read back as None from arrow)
+    def strip(task_json):
+        return {k: v for k, v in task_json.items() if v is not None}
+
+    results = [{"premise_1": strip(each["premise_1"]),
+                "premise_2": strip(each["premise_2"]),
+                "results": [strip(r) for r in each["results"]]}
+               for each in [record["step 1"], record["step 2"]]]
+    return generate_raw_prompt(record["premises"], record["question"], results)
+
+
+def metadata():
+    return {"introduction": INTRODUCTION,
+            "premise_template": PREMISE_TEMPLATE,
+            "question_template": QUESTION_TEMPLATE,
+            "columns": ["premises", "question", "step 1", "step 2"]}
+
+
+if pa is not None:
+    _task_type = pa.struct([("s", pa.string()), ("o", pa.string()), ("cp", pa.string()),
+                            ("f", pa.float64()), ("c", pa.float64()), ("eb", pa.list_(pa.int64())),
+                            ("r", pa.string())])
+    _step_type = pa.struct([("premise_1", _task_type), ("premise_2", _task_type),
+                            ("results", pa.list_(_task_type))])
+    SCHEMA = pa.schema([("premises", pa.list_(pa.string())), ("question", pa.string()),
+                        ("step 1", _step_type), ("step 2", _step_type)],
+                       metadata={"rllmft": json.dumps(metadata())})
+
+
+def table_path(name):
+    return f"data/data_table_{name}.csv"
+
+
+def table_dir(name):
+    # directory of the sharded (jsonl/arrow/parquet) tables
+    return f"data/data_table_{name}"
+
+
+class CsvSink:
+
+    def __init__(self, path, header=True):
+        self.f = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.f, quoting=csv.QUOTE_MINIMAL)
+        if header:
+            self.writer.writerow(COLUMNS)
+
+    def write(self, samples):
+        self.writer.writerows([generate_raw_prompt(*each) for each in samples])
+
+    def close(self):
+        self.f.close()
+
+
+class ShardedSink(ABC):
+    # a new file is started every shard_size samples, named {prefix}-{index}.{ext}
+
+    ext = None
+
+    def __init__(self, directory, prefix="part", shard_size=100000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.count = 0
+        self.shard = -1
+
+    def path(self):
+        return os.path.join(self.directory, f"{self.prefix}-{self.shard:05d}.{self.ext}")
+
+    def write(self, samples):
+        i = 0
+        while i < len(samples):
+            if self.count % self.shard_size == 0:
+                self.close()
+                self.shard += 1
+                self.open()
+            k = min(len(samples) - i, self.shard_size - self.count % self.shard_size)
+            self.write_shard([generate_record(*each) for each in samples[i:i + k]])
+            self.count += k
+            i += k
+
+    @abstractmethod
+    def open(self):
+        pass
+
+    @abstractmethod
+    def write_shard(self, records):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class JsonlSink(ShardedSink):
+    ext = "jsonl"
+
+    def __init__(self, directory, prefix="part", shard_size=100000):
+        super().__init__(directory, prefix, shard_size)
+        self.f = None
+
+    def open(self):
+        self.f = open(self.path(), "w", encoding="utf-8")
+
+    def write_shard(self, records):
+        self.f.writelines(json.dumps(each) + "\n" for each in records)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class ArrowSink(ShardedSink):
+    # arrow ipc files can be memory-mapped, parquet files are smaller
+
+    def __init__(self, directory, prefix="part", shard_size=100000, fmt="arrow"):
+        if pa is None:
+            raise ImportError("pyarrow is required to write arrow/parquet tables")
+        super().__init__(directory, prefix, shard_size)
+        self.ext = fmt
+        self.writer = None
+
+    def open(self):
+        if self.ext == "parquet":
+            self.writer = pq.ParquetWriter(self.path(), SCHEMA)
+        else:
+            self.writer = pa.ipc.new_file(self.path(), SCHEMA)
+
+    def write_shard(self, records):
+        self.writer.write_batch(pa.RecordBatch.from_pylist(records, schema=SCHEMA))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def open_sinks(name, formats, shard_size, shard=None):
+    # shard is given for the pieces generated by worker processes, their csv is merged afterwards
+    sinks = []
+    for fmt in formats:
+        if fmt == "csv":
+            if shard is None:
+                sinks.append(CsvSink(table_path(name)))
+            else:
+                sinks.append(CsvSink(f"{table_path(name)}.part{shard}", header=False))
+        else:
+            prefix = "part" if shard is None else f"part-{shard:05d}"
+            if fmt == "jsonl":
+                sinks.append(JsonlSink(table_dir(name), prefix, shard_size))
+            else:
+                sinks.append(ArrowSink(table_dir(name), prefix, shard_size, fmt))
+    if shard is None:
+        remove_shards(name)
+        write_meta(name, formats)
+    return sinks
+
+
+def remove_shards(name, keep=()):
+    # remove the shard files of a table left by an earlier run (the loaders read all the files of the directory),
+    # except the file names in keep
+    for path in glob.glob(os.path.join(table_dir(name), "part-*")):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+
+
+def write_meta(name, formats):
+    if set(formats) - {"csv"}:
+        os.makedirs(table_dir(name), exist_ok=True)
+        with open(os.path.join(table_dir(name), "_meta.json"), "w", encoding="utf-8") as f:
+            json.dump(metadata(), f, indent=2)
+
+
+def load_meta(directory):
+    with open(os.path.join(directory, "_meta.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_table(directory):
+    # the arrow/parquet shards of a table as one pyarrow table, arrow files are memory-mapped (no copy)
+    if pa is None:
+        raise ImportError("pyarrow is required to load arrow/parquet tables")
+    paths = sorted(glob.glob(os.path.join(directory, "*.arrow")))
+    if paths:
+        return pa.concat_tables([pa.ipc.open_file(pa.memory_map(each)).read_all() for each in paths])
+    return pq.read_table(sorted(glob.glob(os.path.join(directory, "*.parquet"))))
+
+
+def iter_records(directory):
+    # structured samples of a jsonl table, in order
+    for each in sorted(glob.glob(os.path.join(directory, "*.jsonl"))):
+        with open(each, encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def write_samples(sinks, samples, chunk_size=1000):
+    # stream samples to all the sinks, holding at most chunk_size of them at once
+    samples = iter(samples)
+    count = 0
+    while True:
+        chunk = list(islice(samples, chunk_size))
+        if not chunk:
+            break
+        for each in sinks:
+            each.write(chunk)
+        count += len(chunk)
+    for each in sinks:
+        each.close()
+    return count
+
+
+def write_table(name, raw_data, formats, shard_size, total=None, chunk_size=1000, stats=None):
+    # stats is the one filled by the generator of raw_data
+    start = time.perf_counter()
+    sinks = open_sinks(name, formats, shard_size)
+    count = write_samples(sinks, tqdm(raw_data, total=total, desc=name, unit="sample", leave=False), chunk_size)
+    report(name, count, time.perf_counter() - start, (stats or {}).get("rejected", 0))
+
+
+def report(name, count, elapsed, rejected=0):
+    print(f">- data/data_table_{name} generated, {count} samples, {count / max(elapsed, 1e-9):.1f} samples/s, "
+          f"{rejected} rejected")
+
+
+def select_templates(random_seed, num_templates, num_categories):
+    # the templates and truth categories used by all the tables, drawn from their own random stream (seeded), the
+    # global one is left as it is
+    rng = random.Random(random_seed)
+    _inh_template_indices = rng.sample(range(len(_inheritance_templates)), num_templates)
+    _sim_template_indices = rng.sample(range(len(_similarity_templates)), num_templates)
+
+    inheritance_templates = [_inheritance_templates[each] for each in _inh_template_indices]
+    inheritance_templates_q = [_inheritance_templates_q[each] for each in _inh_template_indices]
+
+    similarity_templates = [_similarity_templates[each] for each in _sim_template_indices]
+    similarity_templates_q = [_similarity_templates_q[each] for each in _sim_template_indices]
+
+    truth_categories = [[each[0], each[1], each[2][:num_categories]] for each in _truth_categories]
+
+    return (inheritance_templates, inheritance_templates_q,
+            similarity_templates, similarity_templates_q,
+            truth_categories)
+
+
+def model_cases(random_seed, model_index, num_models):
+    # the cases of a model, all of them are shuffled once by (seed, "cases") and split without overlapping, the same
+    # in all the modes (serial, parallel and indexed) and in the training stream (streaming.py)
+    shuffled = list(cs)
+    random.Random(f"{random_seed}/cases").shuffle(shuffled)
+    return np.array_split(shuffled, num_models)[model_index].tolist()
+
+
+def gen_tables(random_seed, num_data, num_models, templates, formats, shard_size):
+    # all tables from a single random stream
+    G = Generator(random_seed)
+
+    for model_index in range(num_models):
+        stats = {}
+        raw_data = G.iter_random_reasoning(model_cases(random_seed, model_index, num_models), num_data, *templates,
+                                           0, 1, False, stats)
+        write_table(f"{model_index}_{num_models}", raw_data, formats, shard_size, num_data, stats=stats)
+
+    stats = {}
+    raw_data = G.iter_random_reasoning(cs, num_data, *templates, -1, -1, True, stats)
+    write_table("test", raw_data, formats, shard_size, num_data, stats=stats)
+
+
+def gen_shard(name, shard, shard_seed, cases, n, templates, for_testing, formats, shard_size):
+    # one independent piece of a table, runs in a worker process with its own random stream
+    # the cases are already split for the model, so they are all used here
+    G = Generator(shard_seed)
+    stats = {}
+    raw_data = G.iter_random_reasoning(list(cases), n, *templates, 0, 1, for_testing, stats)
+    return write_samples(open_sinks(name, formats, shard_size, shard), raw_data), stats.get("rejected", 0)
+
+
+def gen_tables_parallel(random_seed, num_data, num_models, templates, formats, shard_size, workers):
+    # every table (each model and the test) is split into `workers` shards, each seeded by (seed, table, shard)
+    # so the output only depends on (random_seed, workers)
+    jobs = [(f"{model_index}_{num_models}", model_cases(random_seed, model_index, num_models), False)
+            for model_index in range(num_models)]
+    jobs.append(("test", list(cs), True))
+
+    shard_sizes = [len(each) for each in np.array_split(range(num_data), workers)]
+
+    for name, _, _ in jobs:
+        remove_shards(name)
+        write_meta(name, formats)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [[executor.submit(gen_shard, name, shard, f"{random_seed}/{name}/{shard}", cases, size,
+                                    templates, for_testing, formats, shard_size)
+                    for shard, size in enumerate(shard_sizes)]
+                   for name, cases, for_testing in jobs]
+
+        for (name, _, _), each_futures in zip(jobs, futures):
+            count = sum(each.result()[0] for each in each_futures)
+            rejected = sum(each.result()[1] for each in each_futures)
+            if "csv" in formats:
+                # merge the csv part files in shard order
+                path = table_path(name)
+                with open(path, "w", newline="", encoding="utf-8") as f:
+                    csv.writer(f, quoting=csv.QUOTE_MINIMAL).writerow(COLUMNS)
+                    for shard in range(len(shard_sizes)):
+                        with open(f"{path}.part{shard}", newline="", encoding="utf-8") as part:
+                            shutil.copyfileobj(part, f)
+                        os.remove(f"{path}.part{shard}")
+            report(name, count, time.perf_counter() - start, rejected)
+
+
+def manifest_path(node):
+    return f"data/_manifest_{node}.jsonl"
+
+
+def load_manifest(config):
+    # finished shards of all the nodes, (table, shard) -> entry
+    # config is the generation config of the run (seed, template/category counts, ...), the entries recorded with
+    # another one are ignored, so their shards are generated again
+    done = {}
+    ignored = 0
+    for path in sorted(glob.glob(manifest_path("*"))):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # the last line of a crashed run
+                    continue
+                if entry.get("config") != config:
+                    ignored += 1
+                    continue
+                done[(entry["table"], entry["shard"])] = entry
+    if ignored:
+        print(f">- {ignored} finished shards of another generation config ignored")
+    return done
+
+
+def indexed_jobs(num_models):
+    # (table name, model index, for testing)
+    return [(f"{model_index}_{num_models}", model_index, False) for model_index in range(num_models)] + \
+        [("test", -1, True)]
+
+
+def gen_indexed_shard(name, shard, start, stop, random_seed, model_index, num_models, templates, for_testing, formats,
+                      shard_size):
+    stats = {}
+    cases = list(cs) if for_testing else model_cases(random_seed, model_index, num_models)
+    raw_data = iter_indexed_reasoning(cases, start, stop, *templates, random_seed, model_index, for_testing, stats)
+    return write_samples(open_sinks(name, formats, shard_size, shard), raw_data), stats.get("rejected", 0)
+
+
+def gen_tables_indexed(random_seed, num_data, num_models, templates, formats, shard_size, workers, node, num_nodes,
+                       config):
+    # every table is cut into shards of shard_size samples, sample i only depends on (seed, table, i)
+    # this node generates the shards with shard % num_nodes == node, the finished ones are recorded in its manifest
+    # with the config and skipped when re-run with the same one, so the output does not depend on workers/nodes and
+    # an interrupted run can be resumed
+    done = load_manifest(config)
+    num_shards = (num_data + shard_size - 1) // shard_size
+
+    pending = []
+    for name, model_index, for_testing in indexed_jobs(num_models):
+        write_meta(name, formats)
+        for shard in range(node, num_shards, num_nodes):
+            if (name, shard) not in done:
+                pending.append((name, shard, shard * shard_size, min((shard + 1) * shard_size, num_data), model_index,
+                                for_testing))
+    print(f">- node {node}: {len(pending)} shards to generate, {len(done)} finished shards found")
+
+    start = time.perf_counter()
+    count, rejected = 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+            open(manifest_path(node), "a", encoding="utf-8") as manifest:
+        futures = {executor.submit(gen_indexed_shard, name, shard, shard_start, shard_stop, random_seed, model_index,
+                                   num_models, templates, for_testing, formats, shard_size):
+                   (name, shard, shard_start, shard_stop)
+                   for name, shard, shard_start, shard_stop, model_index, for_testing in pending}
+        for each in tqdm(as_completed(futures), total=len(futures), desc=f"node {node}", unit="shard", leave=False):
+            name, shard, shard_start, shard_stop = futures[each]
+            count += each.result()[0]
+            rejected += each.result()[1]
+            manifest.write(json.dumps({"table": name, "shard": shard, "start": shard_start, "stop": shard_stop,
+                                       "rejected": each.result()[1], "config": config}) + "\n")
+            manifest.flush()
+    print(f">- node {node}: {count} samples, {count / max(time.perf_counter() - start, 1e-9):.1f} samples/s, "
+          f"{rejected} rejected")
+
+
+def merge_indexed(num_data, num_models, formats, shard_size, config):
+    # check the manifests of all the nodes and concatenate the csv shards into the tables
+    done = load_manifest(config)
+    num_shards = (num_data + shard_size - 1) // shard_size
+
+    missing = [(name, shard) for name, _, _ in indexed_jobs(num_models) for shard in range(num_shards)
+               if (name, shard) not in done
+               or done[(name, shard)]["stop"] != min((shard + 1) * shard_size, num_data)]
+    if missing:
+        print(f">- {len(missing)} shards are not finished yet, e.g. {missing[:3]}, tables not merged")
+        return False
+
+    # an indexed shard fits in a single file per format
+    keep = {f"part-{shard:05d}-00000.{fmt}" for shard in range(num_shards) for fmt in formats if fmt != "csv"}
+    for name, _, _ in indexed_jobs(num_models):
+        remove_shards(name, keep)
+    if "csv" in formats:
+        for name, _, _ in indexed_jobs(num_models):
+            path = table_path(name)
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                csv.writer(f, quoting=csv.QUOTE_MINIMAL).writerow(COLUMNS)
+                for shard in range(num_shards):
+                    with open(f"{path}.part{shard}", newline="", encoding="utf-8") as part:
+                        shutil.copyfileobj(part, f)
+            for shard in range(num_shards):
+                os.remove(f"{path}.part{shard}")
+            print(f">- {path} merged")
+    for path in glob.glob(manifest_path("*")):
+        os.remove(path)
+    return True
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
@@ -29,6 +480,19 @@ if __name__ == "__main__":
     parser.add_argument("--num_categories", type=int, default=5, help="Number of categories to use")
     parser.add_argument("--num_models", type=int, default=3, help="Number of LLM models used")
     parser.add_argument("--random_seed", type=int, default=39, help="Random seed")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes, when > 1, each table is generated in shards in parallel")
+    parser.add_argument("--formats", type=str, default="csv",
+                        help=f"Comma separated output formats, from {FORMATS}")
+    parser.add_argument("--shard_size", type=int, default=100000,
+                        help="Number of samples per file of the jsonl/arrow/parquet tables (and per indexed shard)")
+    parser.add_argument("--indexed", action="store_true",
+                        help="Counter-based generation, each sample only depends on (seed, table, index), "
+                             "finished shards are skipped when re-run")
+    parser.add_argument("--node", type=int, default=0, help="Index of this node, with --indexed")
+    parser.add_argument("--num_nodes", type=int, default=1, help="Number of nodes sharing the shards, with --indexed")
+    parser.add_argument("--merge", action="store_true",
+                        help="Only merge the indexed shards of all nodes (listed in data/_manifest_*.jsonl)")
 
     args = parser.parse_args()
 
@@ -37,51 +501,32 @@ if __name__ == "__main__":
     num_categories = args.num_categories
     num_models = args.num_models
     random_seed = args.random_seed
+    workers = args.workers
+    formats = args.formats.split(",")
+    shard_size = args.shard_size
 
-    random.seed(random_seed)
-    _inh_template_indices = random.sample(range(len(_inheritance_templates)), num_templates)
-    _sim_template_indices = random.sample(range(len(_similarity_templates)), num_templates)
-
-    inheritance_templates = [_inheritance_templates[each] for each in _inh_template_indices]
-    inheritance_templates_q = [_inheritance_templates_q[each] for each in _inh_template_indices]
-
-    similarity_templates = [_similarity_templates[each] for each in _sim_template_indices]
-    similarity_templates_q = [_similarity_templates_q[each] for each in _sim_template_indices]
+    for each in formats:
+        if each not in FORMATS:
+            parser.error(f"unknown format {each}, choose from {FORMATS}")
 
-    truth_categories = [[each[0], each[1], each[2][:num_categories]] for each in _truth_categories]
+    random.seed(random_seed)  # the global random stream, not seeded by select_templates
+    templates = select_templates(random_seed, num_templates, num_categories)
+    # the shards of an indexed run are only resumed or merged with the same config
+    config = {"random_seed": random_seed, "num_templates": num_templates, "num_categories": num_categories,
+              "num_models": num_models, "num_data": num_data, "shard_size": shard_size, "formats": formats}
 
-    G = Generator(random_seed)
     os.makedirs("data", exist_ok=True)
     os.makedirs("test_record", exist_ok=True)
 
-    for model_index in range(num_models):
-
-        raw_data = G.gen_random_reasoning(cs,
-                                          num_data,
-                                          inheritance_templates, inheritance_templates_q,
-                                          similarity_templates, similarity_templates_q,
-                                          truth_categories,
-                                          model_index, num_models, False)
-        table = [generate_raw_prompt(*each) for each in raw_data]
-        with open(f"data/data_table_{model_index}_{num_models}.csv", "w", newline="", encoding="utf-8") as f:
-            writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
-            writer.writerow(["Introduction", "Premise", "Question", "Answer"])
-            for row in table:
-                writer.writerow(row)
-            print(f">- data/data_table_{model_index}_{num_models}.csv generated")
-
-    raw_data = G.gen_random_reasoning(cs,
-                                      num_data,
-                                      inheritance_templates, inheritance_templates_q,
-                                      similarity_templates, similarity_templates_q,
-                                      truth_categories,
-                                      -1, -1, True)
-    table = [generate_raw_prompt(*each) for each in raw_data]
-    with open("data/data_table_test.csv", "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(["Introduction", "Premise", "Question", "Answer"])
-        for row in table:
-            writer.writerow(row)
-        print(">- data/data_table_test.csv generated")
+    if args.merge:
+        merge_indexed(num_data, num_models, formats, shard_size, config)
+    elif args.indexed:
+        gen_tables_indexed(random_seed, num_data, num_models, templates, formats, shard_size, workers, args.node,
+                           args.num_nodes, config)
+        merge_indexed(num_data, num_models, formats, shard_size, config)
+    elif workers > 1:
+        gen_tables_parallel(random_seed, num_data, num_models, templates, formats, shard_size, workers)
+    else:
+        gen_tables(random_seed, num_data, num_models, templates, formats, shard_size)
 
     print(">- finished")
@@ -1,4 +1,7 @@
 import random
+import sys
+from array import array
+from collections import defaultdict, deque
 
 import numpy as np
 
@@ -7,26 +10,41 @@ from config import cs, _inheritance_templates, _inheritance_templates_q, _simila
 
 
 class Task:
+    # slotted, with interned terms and an immutable evidential base (sorted once, on demand)
+    __slots__ = ("sub", "obj", "copula", "truth", "eb", "r", "_eb_sorted")
 
     def __init__(self, sub, obj, copula, truth, eb, rl=None):
         # statement
-        self.sub = sub
-        self.obj = obj
+        self.sub = sys.intern(sub) if type(sub) is str else sub
+        self.obj = sys.intern(obj) if type(obj) is str else obj
         self.copula = copula
 
         # truth
         self.truth = truth
-        self.f = truth.f
-        self.c = truth.c
 
         # evidential_base
-        self.eb = eb
+        self.eb = eb if isinstance(eb, frozenset) else frozenset(eb)
+        self._eb_sorted = None
 
         # rules used to derive this task
         self.r = rl
 
+    @property
+    def f(self):
+        return self.truth.f
+
+    @property
+    def c(self):
+        return self.truth.c
+
+    @property
+    def eb_sorted(self):
+        if self._eb_sorted is None:
+            self._eb_sorted = tuple(sorted(self.eb))
+        return self._eb_sorted
+
     def string(self):
-        return f"<{self.sub}{self.copula}{self.obj}>. %{round(self.f, 3)}; {round(self.c, 3)}% {self.eb}"
+        return f"<{self.sub}{self.copula}{self.obj}>. %{round(self.f, 3)}; {round(self.c, 3)}% {set(self.eb)}"
 
     def to_json(self):
         if self.r is None:
@@ -35,18 +53,19 @@ class Task:
                     "cp": self.copula,
                     "f": round(self.f, 3),
                     "c": round(self.c, 3),
-                    "eb": sorted(list(self.eb))}
+                    "eb": list(self.eb_sorted)}
         else:
             return {"s": self.sub,
                     "o": self.obj,
                     "cp": self.copula,
                     "f": round(self.f, 3),
                     "c": round(self.c, 3),
-                    "eb": sorted(list(self.eb)),
+                    "eb": list(self.eb_sorted),
                     "r": self.r}
 
 
 class Truth:
+    __slots__ = ("f", "c")
 
     def __init__(self, f=1., c=0.9):
         self.f = f
@@ -68,7 +87,99 @@ class Truth:
         return f"%{round(self.f, 3)};{round(self.c, 3)}%"
 
 
+class TaskTable:
+    # columnar storage of many tasks (struct-of-arrays), no per-task objects or dicts are kept
+    # terms are interned into integer ids, evidential bases are flattened with offsets
+
+    copulas = ["-->", "<->"]
+    rules = [None, "ded", "ded_p", "ana", "ana_p", "res", "res_p", "abd", "abd_p", "ind", "ind_p", "exe", "exe_p",
+             "com", "com_p"]
+
+    def __init__(self):
+        self.terms = []
+        self.term_ids = {}
+
+        self.sub = array("i")
+        self.obj = array("i")
+        self.copula = array("b")
+        self.f = array("d")
+        self.c = array("d")
+        self.r = array("b")
+        self.eb = array("q")
+        self.eb_offsets = array("q", [0])
+
+    def __len__(self):
+        return len(self.sub)
+
+    def term_id(self, term):
+        if term not in self.term_ids:
+            self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+        return self.term_ids[term]
+
+    def append(self, task: Task):
+        self.sub.append(self.term_id(task.sub))
+        self.obj.append(self.term_id(task.obj))
+        self.copula.append(self.copulas.index(task.copula))
+        self.f.append(task.f)
+        self.c.append(task.c)
+        self.r.append(self.rules.index(task.r))
+        self.eb.extend(task.eb_sorted)
+        self.eb_offsets.append(len(self.eb))
+
+    def extend(self, tasks):
+        for each in tasks:
+            self.append(each)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return Task(self.terms[self.sub[i]],
+                    self.terms[self.obj[i]],
+                    self.copulas[self.copula[i]],
+                    Truth(np.float64(self.f[i]), np.float64(self.c[i])),
+                    self.eb[self.eb_offsets[i]:self.eb_offsets[i + 1]],
+                    self.rules[self.r[i]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_arrays(self):
+        # zero-copy numpy views of all columns
+        return {"terms": np.array(self.terms),
+                "sub": np.frombuffer(self.sub, dtype=np.int32),
+                "obj": np.frombuffer(self.obj, dtype=np.int32),
+                "copula": np.frombuffer(self.copula, dtype=np.int8),
+                "f": np.frombuffer(self.f, dtype=np.float64),
+                "c": np.frombuffer(self.c, dtype=np.float64),
+                "r": np.frombuffer(self.r, dtype=np.int8),
+                "eb": np.frombuffer(self.eb, dtype=np.int64),
+                "eb_offsets": np.frombuffer(self.eb_offsets, dtype=np.int64)}
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        ret = cls()
+        with np.load(path) as data:
+            ret.terms = data["terms"].tolist()
+            ret.term_ids = {each: i for i, each in enumerate(ret.terms)}
+            ret.sub = array("i", data["sub"].tobytes())
+            ret.obj = array("i", data["obj"].tobytes())
+            ret.copula = array("b", data["copula"].tobytes())
+            ret.f = array("d", data["f"].tobytes())
+            ret.c = array("d", data["c"].tobytes())
+            ret.r = array("b", data["r"].tobytes())
+            ret.eb = array("q", data["eb"].tobytes())
+            ret.eb_offsets = array("q", data["eb_offsets"].tobytes())
+        return ret
+
+
 class TruthFunctions:
+    # each truth function has a batched kernel (`*_batch`) working on f/c values, which can be scalars or numpy arrays
+    # holding N premise pairs, the `Truth` based functions are thin wrappers of them
 
     def __init__(self):
         self.tf = {"ded": self.ded,
@@ -86,61 +197,133 @@ class TruthFunctions:
                    "com": self.com,
                    "com_p": self.com_p
                    }
+        self.tf_batch = {"ded": self.ded_batch,
+                         "ded_p": self.ded_p_batch,
+                         "ana": self.ana_batch,
+                         "ana_p": self.ana_p_batch,
+                         "res": self.res_batch,
+                         "res_p": self.res_p_batch,
+                         "abd": self.abd_batch,
+                         "abd_p": self.abd_p_batch,
+                         "ind": self.ind_batch,
+                         "ind_p": self.ind_p_batch,
+                         "exe": self.exe_batch,
+                         "exe_p": self.exe_p_batch,
+                         "com": self.com_batch,
+                         "com_p": self.com_p_batch
+                         }
 
     @staticmethod
     def AND(*values):
-        return np.prod(values)
+        # element-wise, multiplied from left to right (the same order as np.prod on a tuple)
+        # the operators avoid a numpy dispatch per factor for scalars, which are returned as np.float64 (as np.prod
+        # did, e.g., a division by 0 still gives nan instead of raising)
+        ret = values[0]
+        for each in values[1:]:
+            ret = ret * each
+        return ret if isinstance(ret, np.ndarray) else np.float64(ret)
 
     @staticmethod
     def OR(*values):
-        return 1 - np.prod([1 - x for x in values])
+        ret = 1. - values[0]
+        for each in values[1:]:
+            ret = ret * (1. - each)
+        return 1 - (ret if isinstance(ret, np.ndarray) else np.float64(ret))
+
+    # >--
+    # batched kernels, (f1, c1, f2, c2) -> (f, c)
+
+    def ded_batch(self, f1, c1, f2, c2):
+        return self.AND(f1, f2), self.AND(f1, f2, c1, c2)
+
+    def ded_p_batch(self, f1, c1, f2, c2):
+        return self.ded_batch(f2, c2, f1, c1)
+
+    def ana_batch(self, f1, c1, f2, c2):
+        return self.AND(f1, f2), self.AND(f2, c1, c2)
+
+    def ana_p_batch(self, f1, c1, f2, c2):
+        return self.ana_batch(f2, c2, f1, c1)
+
+    def res_batch(self, f1, c1, f2, c2):
+        return self.AND(f1, f2), self.AND(self.OR(f1, f2), c1, c2)
+
+    def res_p_batch(self, f1, c1, f2, c2):
+        return self.res_batch(f2, c2, f1, c1)
+
+    def abd_batch(self, f1, c1, f2, c2):
+        wp = self.AND(f1, f2, c1, c2)
+        w = self.AND(f1, c1, c2)
+        return wp / w, w / (w + 1)
+
+    def abd_p_batch(self, f1, c1, f2, c2):
+        return self.abd_batch(f2, c2, f1, c1)
+
+    def ind_batch(self, f1, c1, f2, c2):
+        wp = self.AND(f1, f2, c1, c2)
+        w = self.AND(f2, c1, c2)
+        return wp / w, w / (w + 1)
+
+    def ind_p_batch(self, f1, c1, f2, c2):
+        return self.ind_batch(f2, c2, f1, c1)
+
+    def exe_batch(self, f1, c1, f2, c2):
+        wp = self.AND(f1, f2, c1, c2)
+        w = self.AND(f1, f2, c1, c2)
+        return wp / w, w / (w + 1)
+
+    def exe_p_batch(self, f1, c1, f2, c2):
+        return self.exe_batch(f2, c2, f1, c1)
+
+    def com_batch(self, f1, c1, f2, c2):
+        wp = self.AND(f1, f2, c1, c2)
+        w = self.AND(self.OR(f1, f2), c1, c2)
+        return wp / w, w / (w + 1)
+
+    def com_p_batch(self, f1, c1, f2, c2):
+        return self.com_batch(f2, c2, f1, c1)
+
+    # >--
+    # scalar wrappers, (Truth, Truth) -> Truth
 
     def ded(self, truth_1: Truth, truth_2: Truth):
-        return Truth(self.AND(truth_1.f, truth_2.f), self.AND(truth_1.f, truth_2.f, truth_1.c, truth_2.c))
+        return Truth(*self.ded_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def ded_p(self, truth_1: Truth, truth_2: Truth):
         return self.ded(truth_2, truth_1)
 
     def ana(self, truth_1: Truth, truth_2: Truth):
-        return Truth(self.AND(truth_1.f, truth_2.f), self.AND(truth_2.f, truth_1.c, truth_2.c))
+        return Truth(*self.ana_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def ana_p(self, truth_1: Truth, truth_2: Truth):
         return self.ana(truth_2, truth_1)
 
     def res(self, truth_1: Truth, truth_2: Truth):
-        return Truth(self.AND(truth_1.f, truth_2.f), self.AND(self.OR(truth_1.f, truth_2.f), truth_1.c, truth_2.c))
+        return Truth(*self.res_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def res_p(self, truth_1: Truth, truth_2: Truth):
         return self.res(truth_2, truth_1)
 
     def abd(self, truth_1: Truth, truth_2: Truth):
-        wp = self.AND(truth_1.f, truth_2.f, truth_1.c, truth_2.c)
-        w = self.AND(truth_1.f, truth_1.c, truth_2.c)
-        return Truth(wp / w, w / (w + 1))
+        return Truth(*self.abd_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def abd_p(self, truth_1: Truth, truth_2: Truth):
         return self.abd(truth_2, truth_1)
 
     def ind(self, truth_1: Truth, truth_2: Truth):
-        wp = self.AND(truth_1.f, truth_2.f, truth_1.c, truth_2.c)
-        w = self.AND(truth_2.f, truth_1.c, truth_2.c)
-        return Truth(wp / w, w / (w + 1))
+        return Truth(*self.ind_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def ind_p(self, truth_1: Truth, truth_2: Truth):
         return self.ind(truth_2, truth_1)
 
     def exe(self, truth_1: Truth, truth_2: Truth):
-        wp = self.AND(truth_1.f, truth_2.f, truth_1.c, truth_2.c)
-        w = self.AND(truth_1.f, truth_2.f, truth_1.c, truth_2.c)
-        return Truth(wp / w, w / (w + 1))
+        return Truth(*self.exe_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def exe_p(self, truth_1: Truth, truth_2: Truth):
         return self.exe(truth_2, truth_1)
 
     def com(self, truth_1: Truth, truth_2: Truth):
-        wp = self.AND(truth_1.f, truth_2.f, truth_1.c, truth_2.c)
-        w = self.AND(self.OR(truth_1.f, truth_2.f), truth_1.c, truth_2.c)
-        return Truth(wp / w, w / (w + 1))
+        return Truth(*self.com_batch(truth_1.f, truth_1.c, truth_2.f, truth_2.c))
 
     def com_p(self, truth_1: Truth, truth_2: Truth):
         return self.com(truth_2, truth_1)
@@ -149,110 +332,204 @@ class TruthFunctions:
 TFS = TruthFunctions()
 
 
-def reasoning(task_1: Task, task_2: Task):
-    ret = []
-
-    if task_1.sub == task_2.obj and task_1.copula == task_2.copula == "-->":
+# syllogistic dispatch table, (copula_1, copula_2) -> [(shared term in task_1, shared term in task_2, case,
+# conclusions), ...], ordered by priority when several terms are shared
+# each conclusion is (subject, object, copula, truth function), where a term is (0 for task_1 / 1 for task_2, attribute)
+_syllogisms = {
+    ("-->", "-->"): [
         # MP, SM -> SP(ded), PS('exe)
-        t = Task(task_2.sub, task_1.obj, "-->", TFS.ded(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "ded")
-        ret.append(t)
-        t = Task(task_1.obj, task_2.sub, "-->", TFS.exe_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "exe_p")
-        ret.append(t)
-        flag = "MP, SM"
-    elif task_1.obj == task_2.obj and task_1.copula == task_2.copula == "-->":
+        ("sub", "obj", "MP, SM", [((1, "sub"), (0, "obj"), "-->", "ded"),
+                                  ((0, "obj"), (1, "sub"), "-->", "exe_p")]),
         # PM, SM -> SP(abd), PS('abd), S<>P('com)
-        t = Task(task_2.sub, task_1.sub, "-->", TFS.abd(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "abd")
-        ret.append(t)
-        t = Task(task_1.sub, task_2.sub, "-->", TFS.abd_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "abd_p")
-        ret.append(t)
-        t = Task(task_2.sub, task_1.sub, "<->", TFS.com_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "com_p")
-        ret.append(t)
-        # t = Task(task_1.sub, task_2.sub, "<->", TFS.com_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "com_p")
-        # ret.append(t)
-        flag = "PM, SM"
-    elif task_1.sub == task_2.obj and task_1.copula == "<->" and task_2.copula == "-->":
-        # M<>P, SM -> SP('ana)
-        t = Task(task_2.sub, task_1.obj, "-->", TFS.ana_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "ana_p")
-        ret.append(t)
-        flag = "M<>P, SM"
-    elif task_1.sub == task_2.sub and task_1.copula == task_2.copula == "-->":
+        ("obj", "obj", "PM, SM", [((1, "sub"), (0, "sub"), "-->", "abd"),
+                                  ((0, "sub"), (1, "sub"), "-->", "abd_p"),
+                                  ((1, "sub"), (0, "sub"), "<->", "com_p")]),
         # MP, MS -> SP(ind), PS('ind), S<>P(com)
-        t = Task(task_2.obj, task_1.obj, "-->", TFS.ind(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "ind")
-        ret.append(t)
-        t = Task(task_1.obj, task_2.obj, "-->", TFS.ind_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "ind_p")
-        ret.append(t)
-        t = Task(task_2.obj, task_1.obj, "<->", TFS.com(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "com")
-        ret.append(t)
-        # t = Task(task_1.obj, task_2.obj, "<->", TFS.com(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "com")
-        # ret.append(t)
-        flag = "MP, MS"
-    elif task_1.obj == task_2.sub and task_1.copula == task_2.copula == "-->":
+        ("sub", "sub", "MP, MS", [((1, "obj"), (0, "obj"), "-->", "ind"),
+                                  ((0, "obj"), (1, "obj"), "-->", "ind_p"),
+                                  ((1, "obj"), (0, "obj"), "<->", "com")]),
         # PM, MS -> SP(exe), PS('ded)
-        t = Task(task_2.obj, task_1.sub, "-->", TFS.exe(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "exe")
-        ret.append(t)
-        t = Task(task_1.sub, task_2.obj, "-->", TFS.ded_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "ded_p")
-        ret.append(t)
-        flag = "PM, MS"
-    elif task_1.sub == task_2.sub and task_1.copula == "<->" and task_2.copula == "-->":
+        ("obj", "sub", "PM, MS", [((1, "obj"), (0, "sub"), "-->", "exe"),
+                                  ((0, "sub"), (1, "obj"), "-->", "ded_p")])
+    ],
+    ("<->", "-->"): [
+        # M<>P, SM -> SP('ana)
+        ("sub", "obj", "M<>P, SM", [((1, "sub"), (0, "obj"), "-->", "ana_p")]),
         # M<>P, MS -> PS('ana)
-        t = Task(task_1.obj, task_2.obj, "-->", TFS.ana_p(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb),
-                 "ana_p")
-        ret.append(t)
-        flag = "M<>P, MS"
-    elif task_1.sub == task_2.obj and task_1.copula == "-->" and task_2.copula == "<->":
+        ("sub", "sub", "M<>P, MS", [((0, "obj"), (1, "obj"), "-->", "ana_p")])
+    ],
+    ("-->", "<->"): [
         # MP, S<>M -> SP(ana)
-        t = Task(task_2.sub, task_1.obj, "-->", TFS.ana(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "ana")
-        ret.append(t)
-        flag = "MP, S<>M"
-    elif task_1.obj == task_2.obj and task_1.copula == "-->" and task_2.copula == "<->":
+        ("sub", "obj", "MP, S<>M", [((1, "sub"), (0, "obj"), "-->", "ana")]),
         # PM, S<>M -> PS(ana)
-        t = Task(task_1.sub, task_2.sub, "-->", TFS.ana(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "ana")
-        ret.append(t)
-        flag = "PM, S<>M"
-    elif task_1.sub == task_2.obj and task_1.copula == task_2.copula == "<->":
+        ("obj", "obj", "PM, S<>M", [((0, "sub"), (1, "sub"), "-->", "ana")])
+    ],
+    ("<->", "<->"): [
         # M<>P, S<>M -> S<>P(res)
-        t = Task(task_2.sub, task_1.obj, "<->", TFS.res(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "res")
-        ret.append(t)
-        # t = Task(task_1.obj, task_2.sub, "<->", TFS.res(task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), "res")
-        # ret.append(t)
-        flag = "M<>P, S<>M"
+        ("sub", "obj", "M<>P, S<>M", [((1, "sub"), (0, "obj"), "<->", "res")])
+    ]
+}
+
+
+def match_case(task_1: Task, task_2: Task):
+    # the applicable entry in the dispatch table, None if the two tasks cannot be used together
+    for each in _syllogisms.get((task_1.copula, task_2.copula), []):
+        if getattr(task_1, each[0]) == getattr(task_2, each[1]):
+            return each
+    return None
+
+
+def reasoning(task_1: Task, task_2: Task):
+    matched = match_case(task_1, task_2)
+    if matched is None:
+        return []
+
+    tasks = (task_1, task_2)
+    ret = []
+    for (i_s, a_s), (i_o, a_o), copula, rule in matched[3]:
+        ret.append(Task(getattr(tasks[i_s], a_s), getattr(tasks[i_o], a_o), copula,
+                        TFS.tf[rule](task_1.truth, task_2.truth), task_1.eb.union(task_2.eb), rule))
+    return ret
 
+
+def reasoning_batch(pairs):
+    # [reasoning(task_1, task_2), ...] of many premise pairs, the truth values are computed by one call of the batched
+    # kernel of each rule, over all the pairs using it
+    matched = [match_case(task_1, task_2) for task_1, task_2 in pairs]
+    conclusions = [[] if each is None else each[3] for each in matched]
+    slots = defaultdict(list)  # rule -> [(pair index, conclusion index), ...]
+    for i, each in enumerate(conclusions):
+        for j, (_, _, _, rule) in enumerate(each):
+            slots[rule].append((i, j))
+
+    truths = {}
+    for rule, indices in slots.items():
+        premises = np.array([(pairs[i][0].f, pairs[i][0].c, pairs[i][1].f, pairs[i][1].c) for i, _ in indices])
+        for index, f, c in zip(indices, *TFS.tf_batch[rule](*premises.T)):
+            truths[index] = Truth(f, c)
+
+    ret = []
+    for i, (tasks, each) in enumerate(zip(pairs, conclusions)):
+        ret.append([Task(getattr(tasks[i_s], a_s), getattr(tasks[i_o], a_o), copula, truths[(i, j)],
+                         tasks[0].eb.union(tasks[1].eb), rule)
+                    for j, ((i_s, a_s), (i_o, a_o), copula, rule) in enumerate(each)])
     return ret
 
 
-def get_truth_label(freq, truth_categories):
+class KnowledgeBase:
+    # forward-chaining over many premises
+    # tasks are indexed by (term position, copula, term), so a new task is only paired with the tasks sharing a term
+    # conclusions are deduplicated by their statement and evidential base
+
+    def __init__(self, overlapping_evidence=False):
+        # by default, two tasks with overlapping evidential bases are not used together (otherwise chains never end)
+        self.overlapping_evidence = overlapping_evidence
+
+        self.tasks = []
+        self.index = defaultdict(list)  # (position, copula, term) -> tasks
+        self.statements = defaultdict(list)  # (s, o, cp) -> tasks
+        self.seen = set()  # (s, o, cp, eb)
+        self.parents = {}  # (s, o, cp, eb) -> (task_1, task_2)
+        self.pending = deque()
+
+    @staticmethod
+    def key(task: Task):
+        return task.sub, task.obj, task.copula, task.eb
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task: Task, parents=None):
+        # queue a task for reasoning, return False if it is already known
+        k = self.key(task)
+        if k in self.seen:
+            return False
+        self.seen.add(k)
+        if parents is not None:
+            self.parents[k] = parents
+        self.pending.append(task)
+        return True
+
+    def candidates(self, task: Task):
+        # ordered pairs (task_1, task_2) between the task and the indexed ones, found by term lookups only
+        pairs = {}
+        for (cp_1, cp_2), entries in _syllogisms.items():
+            for pos_1, pos_2, _, _ in entries:
+                if cp_2 == task.copula:
+                    for each in self.index[(pos_1, cp_1, getattr(task, pos_2))]:
+                        pairs[(id(each), 1)] = (each, task)
+                if cp_1 == task.copula:
+                    for each in self.index[(pos_2, cp_2, getattr(task, pos_1))]:
+                        pairs[(id(each), 0)] = (task, each)
+        return pairs.values()
+
+    def step(self):
+        # pair the next pending task with the known ones and index it, return the new conclusions
+        task = self.pending.popleft()
+        ret = []
+        pairs = [(task_1, task_2) for task_1, task_2 in self.candidates(task)
+                 if self.overlapping_evidence or task_1.eb.isdisjoint(task_2.eb)]
+        for parents, conclusions in zip(pairs, reasoning_batch(pairs)):
+            for each in conclusions:
+                if self.add(each, parents):
+                    ret.append(each)
+
+        self.tasks.append(task)
+        for position in ["sub", "obj"]:
+            self.index[(position, task.copula, getattr(task, position))].append(task)
+        self.statements[(task.sub, task.obj, task.copula)].append(task)
+        return ret
+
+    def run(self, max_steps=None):
+        # reason until nothing is pending (or max_steps tasks are processed), return all new conclusions
+        ret = []
+        count = 0
+        while self.pending and (max_steps is None or count < max_steps):
+            ret.extend(self.step())
+            count += 1
+        return ret
+
+    def find(self, sub, obj, copula):
+        return self.statements.get((sub, obj, copula), [])
+
+    def proof(self, task: Task):
+        # steps deriving the task, from the premises to the task itself, in the format of parse_output
+        ret = []
+        parents = self.parents.get(self.key(task))
+        if parents is not None:
+            for each in parents:
+                ret.extend(self.proof(each))
+            ret.append(parse_output(*parents, [task]))
+        return ret
+
+
+def get_truth_label(freq, truth_categories, rng=random):
     for lower, upper, labels in truth_categories:
         if lower <= freq < upper:
-            return random.choice(labels)
+            return rng.choice(labels)
 
 
-def render_input(task: Task, inheritance_templates, similarity_templates, truth_categories):
+def render_input(task: Task, inheritance_templates, similarity_templates, truth_categories, rng=random):
     evidence_str = ", ".join(map(str, task.eb))
-    truth_label = get_truth_label(task.f, truth_categories)
+    truth_label = get_truth_label(task.f, truth_categories, rng)
 
     if task.copula == "-->":
-        template = random.choice(inheritance_templates)
+        template = rng.choice(inheritance_templates)
         base_sentence = template.format(sub=task.sub, obj=task.obj)
         return f"{base_sentence}. This statement {truth_label}, based on evidence from evidence {{{evidence_str}}}."
     elif task.copula == "<->":
-        template = random.choice(similarity_templates)
+        template = rng.choice(similarity_templates)
         base_sentence = template.format(sub=task.sub, obj=task.obj)
         return f"{base_sentence}. This statement {truth_label}, based on evidence from evidence {{{evidence_str}}}."
 
 
-def render_question(task: Task, inheritance_templates_q, similarity_templates_q):
+def render_question(task: Task, inheritance_templates_q, similarity_templates_q, rng=random):
     if task.copula == "-->":
-        template = random.choice(inheritance_templates_q)
+        template = rng.choice(inheritance_templates_q)
         base_sentence = template.format(sub=task.sub, obj=task.obj)
         return base_sentence
     elif task.copula == "<->":
-        template = random.choice(similarity_templates_q)
+        template = rng.choice(similarity_templates_q)
         base_sentence = template.format(sub=task.sub, obj=task.obj)
         return base_sentence
 
@@ -264,144 +541,226 @@ def parse_output(task_1: Task, task_2: Task, results: [Task, ...]):
     return ret
 
 
-def instantiate_and_reasoning(S, M, P, case, J1=None, J2=None):
+def instantiate_and_reasoning(S, M, P, case, J1=None, J2=None, rng=random):
     Rs = []
 
     while True:
-        eb1 = {random.randint(0, 10000) for _ in range(random.randint(1, 2))} if not J1 else J1.eb
-        eb2 = {random.randint(0, 10000) for _ in range(random.randint(1, 2))} if not J2 else J2.eb
+        eb1 = {rng.randint(0, 10000) for _ in range(rng.randint(1, 2))} if not J1 else J1.eb
+        eb2 = {rng.randint(0, 10000) for _ in range(rng.randint(1, 2))} if not J2 else J2.eb
         if eb1 != eb2:
             break
 
     if case == "MP, SM":
-        J1 = J1 or Task(M, P, "-->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(S, M, "-->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(M, P, "-->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(S, M, "-->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "PM, SM":
-        J1 = J1 or Task(P, M, "-->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(S, M, "-->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(P, M, "-->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(S, M, "-->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "M<>P, SM":
-        J1 = J1 or Task(M, P, "<->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(S, M, "-->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(M, P, "<->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(S, M, "-->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "MP, MS":
-        J1 = J1 or Task(M, P, "-->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(M, S, "-->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(M, P, "-->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(M, S, "-->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "PM, MS":
-        J1 = J1 or Task(P, M, "-->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(M, S, "-->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(P, M, "-->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(M, S, "-->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "M<>P, MS":
-        J1 = J1 or Task(M, P, "<->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(M, S, "-->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(M, P, "<->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(M, S, "-->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "MP, S<>M":
-        J1 = J1 or Task(M, P, "-->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(S, M, "<->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(M, P, "-->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(S, M, "<->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "PM, S<>M":
-        J1 = J1 or Task(P, M, "-->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(S, M, "<->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(P, M, "-->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(S, M, "<->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
     elif case == "M<>P, S<>M":
-        J1 = J1 or Task(M, P, "<->", Truth(random.random(), 0.9), eb1)
-        J2 = J2 or Task(S, M, "<->", Truth(random.random(), 0.9), eb2)
+        J1 = J1 or Task(M, P, "<->", Truth(rng.random(), 0.9), eb1)
+        J2 = J2 or Task(S, M, "<->", Truth(rng.random(), 0.9), eb2)
         Rs = reasoning(J1, J2)
 
     return J1, J2, Rs
 
 
-def gen_random_reasoning(cases,
-                         n,
-                         inheritance_templates, inheritance_templates_q,
-                         similarity_templates, similarity_templates_q,
-                         truth_categories,
-                         model_index=0, num_models=1, for_testing=False):
+_case_slots = {}
+
+
+def case_slots(case):
+    # copula -> (slot, (role of the subject, role of the object)), the first premise slot of the case (e.g. "MP, S<>M")
+    # that a task with the copula can fill, compiled once per case
+    if case not in _case_slots:
+        slots = {}
+        for i, each in enumerate(case.split(", ")):
+            copula = "<->" if "<>" in each else "-->"
+            if copula not in slots:
+                each = each.replace("<>", "")
+                slots[copula] = (i, (each[0], each[1]))
+        _case_slots[case] = slots
+    return _case_slots[case]
+
+
+def gen_one_reasoning(accessible_case,
+                      inheritance_templates, inheritance_templates_q,
+                      similarity_templates, similarity_templates_q,
+                      truth_categories,
+                      rng=random):
+    # a single sample, None when no accessible case can take the step-1 conclusion as a premise
+    # note that accessible_case is shuffled in place
+
+    # find a case for step-1 reasoning
+    case_1 = rng.choice(accessible_case)
+    S_1, M_1, P_1 = [f"ID_{each}" for each in rng.sample(range(0, 100000), 3)]
+    J1_1, J2_1, Rs_1 = instantiate_and_reasoning(S_1, M_1, P_1, case_1, rng=rng)
+    Rs_1 = rng.choice(Rs_1)
+
+    # fine J1 distracting premises
+    dt_case_1 = rng.choice(accessible_case)  # dt for distracting
+    while True:
+        # avoiding as the same as the non-distracting one (though very unlikely)
+        dt_S_1, dt_M_1, dt_P_1 = [f"ID_{each}" for each in rng.sample(range(0, 100000), 3)]
+        if dt_S_1 != S_1 or dt_M_1 != M_1 or dt_P_1 != P_1:
+            break
+    dt_J1_1, dt_J2_1, _ = instantiate_and_reasoning(dt_S_1, dt_M_1, dt_P_1, dt_case_1, rng=rng)
+
+    # >--
+    # go for step-2 reasoning
+
+    # get SMP/case for step-2
+    while True:
+        S_2, M_2, P_2 = [f"ID_{each}" for each in rng.sample(range(0, 100000), 3)]
+        if len({S_1, M_1, P_1, S_2, M_2, P_2}) == 6:
+            break
+    d = {"S": S_2, "M": M_2, "P": P_2}
+    rng.shuffle(accessible_case)
+    for case_2 in accessible_case:
+        slot = case_slots(case_2).get(Rs_1.copula)
+        if slot is not None:
+            break
+    else:
+        return None
+    mk, (role_sub, role_obj) = slot
+    d[role_sub], d[role_obj] = Rs_1.sub, Rs_1.obj
+
+    if mk == 0:
+        J1_2 = Rs_1
+        _, J2_2, Rs_2 = instantiate_and_reasoning(d["S"], d["M"], d["P"], case_2, J1=Rs_1, rng=rng)
+    elif mk == 1:
+        J2_2 = Rs_1
+        J1_2, _, Rs_2 = instantiate_and_reasoning(d["S"], d["M"], d["P"], case_2, J2=Rs_1, rng=rng)
+
+    Rs_2 = rng.choice(Rs_2)
+
+    premises_texts = [render_input(J1_1, inheritance_templates, similarity_templates, truth_categories, rng),
+                      render_input(J2_1, inheritance_templates, similarity_templates, truth_categories, rng),
+                      render_input(dt_J1_1, inheritance_templates, similarity_templates, truth_categories, rng),
+                      render_input(dt_J2_1, inheritance_templates, similarity_templates, truth_categories, rng)]
+    if mk == 0:
+        premises_texts.append(render_input(J2_2, inheritance_templates, similarity_templates, truth_categories, rng))
+    if mk == 1:
+        premises_texts.append(render_input(J1_2, inheritance_templates, similarity_templates, truth_categories, rng))
+
+    question = render_question(Rs_2, inheritance_templates_q, similarity_templates_q, rng)
+    results_jsons = [parse_output(J1_1, J2_1, [Rs_1]),
+                     parse_output(J1_2, J2_2, [Rs_2])]
+    return [premises_texts, question, results_jsons]
+
+
+def split_cases(cases, model_index, num_models, rng=random):
+    # split all cases with no overlapping
+    shuffled = list(cases)
+    rng.shuffle(shuffled)
+    return np.array_split(shuffled, num_models)[model_index].tolist()
+
+
+def iter_random_reasoning(cases,
+                          n,
+                          inheritance_templates, inheritance_templates_q,
+                          similarity_templates, similarity_templates_q,
+                          truth_categories,
+                          model_index=0, num_models=1, for_testing=False, stats=None):
+    # yield exactly n samples one at a time, so that memory does not grow with n
+    # samples whose step-1 conclusion fits no accessible case are redrawn, and counted in stats["rejected"]
     # different models (marked by indices) are trained using different rules to simulate the bias
     # though tested with all rules, when for_testing is true
 
     if not for_testing:
-        # split all cases with no overlapping
-        shuffled = list(cases)
-        random.shuffle(shuffled)
-        accessible_case = np.array_split(shuffled, num_models)[model_index].tolist()
+        accessible_case = split_cases(cases, model_index, num_models)
     else:
-        accessible_case = cases
+        # a copy, gen_one_reasoning shuffles it in place and cases may be config.cs itself
+        accessible_case = list(cases)
+
+    count = 0
+    while count < n:
+        sample = gen_one_reasoning(accessible_case,
+                                   inheritance_templates, inheritance_templates_q,
+                                   similarity_templates, similarity_templates_q,
+                                   truth_categories)
+        if sample is None:
+            if stats is not None:
+                stats["rejected"] = stats.get("rejected", 0) + 1
+            continue
+        count += 1
+        yield sample
 
-    ret = []
-    for _ in range(n):
 
-        # find a case for step-1 reasoning
-        case_1 = random.choice(accessible_case)
-        S_1, M_1, P_1 = [f"ID_{each}" for each in random.sample(range(0, 100000), 3)]
-        J1_1, J2_1, Rs_1 = instantiate_and_reasoning(S_1, M_1, P_1, case_1)
-        Rs_1 = random.choice(Rs_1)
+def sample_rng(random_seed, split, model_index, sample_index):
+    # string seeds are hashed (sha512), so the stream does not depend on the process or the platform
+    return random.Random(f"{random_seed}/{split}/{model_index}/{sample_index}")
 
-        # fine J1 distracting premises
-        dt_case_1 = random.choice(accessible_case)  # dt for distracting
-        while True:
-            # avoiding as the same as the non-distracting one (though very unlikely)
-            dt_S_1, dt_M_1, dt_P_1 = [f"ID_{each}" for each in random.sample(range(0, 100000), 3)]
-            if dt_S_1 != S_1 or dt_M_1 != M_1 or dt_P_1 != P_1:
-                break
-        dt_J1_1, dt_J2_1, _ = instantiate_and_reasoning(dt_S_1, dt_M_1, dt_P_1, dt_case_1)
 
-        # >--
-        # go for step-2 reasoning
+def iter_indexed_reasoning(cases,
+                           start, stop,
+                           inheritance_templates, inheritance_templates_q,
+                           similarity_templates, similarity_templates_q,
+                           truth_categories,
+                           random_seed, model_index=0, for_testing=False, stats=None):
+    # samples [start, stop), each one is a pure function of (random_seed, split, model_index, sample_index) using
+    # its own random stream, so any range can be generated (or resumed) independently
+    # cases are those of the model (already split, as by data_gen.model_cases), or all of them for testing
+    split = "test" if for_testing else "train"
+    accessible_case = sorted(cases)
 
-        # get SMP/case for step-2
+    for i in range(start, stop):
+        rng = sample_rng(random_seed, split, model_index, i)
         while True:
-            S_2, M_2, P_2 = [f"ID_{each}" for each in random.sample(range(0, 100000), 3)]
-            if len({S_1, M_1, P_1, S_2, M_2, P_2}) == 6:
-                break
-        d = {"S": S_2, "M": M_2, "P": P_2}
-        random.shuffle(accessible_case)
-        mk = -1
-        for each_case in accessible_case:
-            if mk != -1:
-                break
-            for i, each in enumerate(each_case.split(", ")):
-                if ("<>" in each and Rs_1.copula != "<->") or ("<>" not in each and Rs_1.copula != "-->"):
-                    continue
-                each = each.replace("<>", "")
-                d[each[0]], d[each[1]] = Rs_1.sub, Rs_1.obj
-                mk = i
-                case_2 = each_case
+            sample = gen_one_reasoning(list(accessible_case),
+                                       inheritance_templates, inheritance_templates_q,
+                                       similarity_templates, similarity_templates_q,
+                                       truth_categories,
+                                       rng)
+            if sample is not None:
                 break
+            if stats is not None:
+                stats["rejected"] = stats.get("rejected", 0) + 1
+        yield sample
 
-        if mk == -1:
-            continue
-        elif mk == 0:
-            J1_2 = Rs_1
-            _, J2_2, Rs_2 = instantiate_and_reasoning(d["S"], d["M"], d["P"], case_2, J1=Rs_1)
-        elif mk == 1:
-            J2_2 = Rs_1
-            J1_2, _, Rs_2 = instantiate_and_reasoning(d["S"], d["M"], d["P"], case_2, J2=Rs_1)
-
-        Rs_2 = random.choice(Rs_2)
-
-        premises_texts = [render_input(J1_1, inheritance_templates, similarity_templates, truth_categories),
-                          render_input(J2_1, inheritance_templates, similarity_templates, truth_categories),
-                          render_input(dt_J1_1, inheritance_templates, similarity_templates, truth_categories),
-                          render_input(dt_J2_1, inheritance_templates, similarity_templates, truth_categories)]
-        if mk == 0:
-            premises_texts.append(render_input(J2_2, inheritance_templates, similarity_templates, truth_categories))
-        if mk == 1:
-            premises_texts.append(render_input(J1_2, inheritance_templates, similarity_templates, truth_categories))
-
-        question = render_question(Rs_2, inheritance_templates_q, similarity_templates_q)
-        results_jsons = [parse_output(J1_1, J2_1, [Rs_1]),
-                         parse_output(J1_2, J2_2, [Rs_2])]
-        ret.append([premises_texts, question, results_jsons])
 
-    return ret
+def gen_random_reasoning(cases,
+                         n,
+                         inheritance_templates, inheritance_templates_q,
+                         similarity_templates, similarity_templates_q,
+                         truth_categories,
+                         model_index=0, num_models=1, for_testing=False, stats=None):
+    return list(iter_random_reasoning(cases,
+                                      n,
+                                      inheritance_templates, inheritance_templates_q,
+                                      similarity_templates, similarity_templates_q,
+                                      truth_categories,
+                                      model_index, num_models, for_testing, stats))
 
 
 class Generator:
 
     def __init__(self, random_seed):
+        self.random_seed = random_seed
         random.seed(random_seed)
 
     @staticmethod
@@ -410,13 +769,41 @@ class Generator:
                              inheritance_templates=None, inheritance_templates_q=None,
                              similarity_templates=None, similarity_templates_q=None,
                              truth_categories=None,
-                             model_index=0, num_models=1, uniform_sampling=False):
+                             model_index=0, num_models=1, uniform_sampling=False, stats=None):
         return gen_random_reasoning(cases,
                                     n,
                                     inheritance_templates, inheritance_templates_q,
                                     similarity_templates, similarity_templates_q,
                                     truth_categories,
-                                    model_index, num_models, uniform_sampling)
+                                    model_index, num_models, uniform_sampling, stats)
+
+    @staticmethod
+    def iter_random_reasoning(cases,
+                              n=1,
+                              inheritance_templates=None, inheritance_templates_q=None,
+                              similarity_templates=None, similarity_templates_q=None,
+                              truth_categories=None,
+                              model_index=0, num_models=1, uniform_sampling=False, stats=None):
+        return iter_random_reasoning(cases,
+                                     n,
+                                     inheritance_templates, inheritance_templates_q,
+                                     similarity_templates, similarity_templates_q,
+                                     truth_categories,
+                                     model_index, num_models, uniform_sampling, stats)
+
+    def iter_indexed_reasoning(self,
+                               cases,
+                               start, stop,
+                               inheritance_templates=None, inheritance_templates_q=None,
+                               similarity_templates=None, similarity_templates_q=None,
+                               truth_categories=None,
+                               model_index=0, uniform_sampling=False, stats=None):
+        return iter_indexed_reasoning(cases,
+                                      start, stop,
+                                      inheritance_templates, inheritance_templates_q,
+                                      similarity_templates, similarity_templates_q,
+                                      truth_categories,
+                                      self.random_seed, model_index, uniform_sampling, stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+
+def canonical(obj):
+    # the canonical json string of a (label or response) json object, independent of the order of the keys
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def grade_key(version, label, *responses):
+    # content address of a grade
+    return hashlib.sha256(canonical([version, label, *responses]).encode("utf-8")).hexdigest()
+
+
+class GradeCache:
+    # on-disk cache of grades, key -> (score, error), bounded to max_entries (least recently used evicted)
+
+    def __init__(self, path, max_entries=1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS grades "
+                                "(key TEXT PRIMARY KEY, score REAL, error TEXT, used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS grades_used ON grades (used)")
+        self.connection.commit()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def get_many(self, keys, query_size=500):
+        # {key: (score, error)} for the keys in the cache, the hits are marked as used
+        keys = list(dict.fromkeys(keys))
+        ret = {}
+        for i in range(0, len(keys), query_size):
+            query = keys[i:i + query_size]
+            ret.update((key, (score, error)) for key, score, error in self.connection.execute(
+                f"SELECT key, score, error FROM grades WHERE key IN ({','.join('?' * len(query))})", query))
+
+        now = time.time()
+        self.connection.executemany("UPDATE grades SET used = ? WHERE key = ?", [(now, key) for key in ret])
+        self.connection.commit()
+
+        self.hits += len(ret)
+        self.misses += len(keys) - len(ret)
+        return ret
+
+    def put_many(self, grades):
+        # grades is {key: (score, error)}
+        now = time.time()
+        self.connection.executemany("INSERT OR REPLACE INTO grades VALUES (?, ?, ?, ?)",
+                                    [(key, float(score), error, now) for key, (score, error) in grades.items()])
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        # drop the least recently used grades beyond max_entries
+        extra = len(self) - self.max_entries
+        if extra > 0:
+            self.connection.execute("DELETE FROM grades WHERE key IN "
+                                    "(SELECT key FROM grades ORDER BY used LIMIT ?)", (extra,))
+            self.connection.commit()
+            self.evictions += extra
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM grades").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.,
+                "evictions": self.evictions, "entries": len(self)}
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
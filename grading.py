@@ -1,5 +1,10 @@
+import argparse
 import csv
+import math
 import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import permutations
 
 import json
 
@@ -8,6 +13,9 @@ from matplotlib import pyplot as plt
 from scipy.optimize import linear_sum_assignment
 
 from formal_reasoning import Task, Truth, reasoning
+from grade_cache import GradeCache, grade_key
+
+GRADER_VERSION = "1"  # bump when the grading changes, the cached grades of other versions are never hit again
 
 
 def parsing_json(json_output):
@@ -66,6 +74,42 @@ def fc_similarity_score(fc1, fc2):
         return 0.1
 
 
+def fc_similarity_scores(fc1, fc2):
+    # element-wise fc_similarity_score on arrays
+    diff = np.abs(np.asarray(fc1, dtype=np.float64) - np.asarray(fc2, dtype=np.float64))
+    norm_diff = (diff - 0.05) / 0.15
+    return np.where(diff <= 0.05, 1.0, np.where(diff <= 0.2, 0.1 + 0.9 * (1 - norm_diff) ** 2, 0.1))
+
+
+_keys = ["s", "o", "cp", "eb", "r"]
+
+
+def assignments(rows, cols):
+    # all the (row, col) pairings of a rows x cols assignment problem, each sorted by row
+    if rows <= cols:
+        return [list(enumerate(each)) for each in permutations(range(cols), rows)]
+    return [sorted((r, c) for c, r in enumerate(each)) for each in permutations(range(rows), cols)]
+
+
+def assign(scores):
+    # row and column indices of the assignment with the maximum total score
+    # tiny problems (the usual 1 x 2 or 1 x 3 ones) are enumerated, where scipy's overhead would dominate
+    # with several rows, ties are left to scipy, since different assignments of the same total can sum to different
+    # a (in the last digits)
+    rows, cols = scores.shape
+    if rows == 0 or cols == 0:
+        return [], []
+    if rows == 1:
+        return [0], [int(np.argmax(scores[0]))]
+    if math.perm(max(rows, cols), min(rows, cols)) <= 24:
+        candidates = assignments(rows, cols)
+        totals = np.array([sum(scores[r, c] for r, c in pairs) for pairs in candidates])
+        best = int(np.argmax(totals))
+        if np.sum(totals >= totals[best] - 1e-9) == 1:
+            return [r for r, _ in candidates[best]], [c for _, c in candidates[best]]
+    return linear_sum_assignment(-scores)
+
+
 def grade_0(json_outputs):
     # grade 2 steps in reasoning
     # grade each individual step
@@ -79,7 +123,7 @@ def grade_0(json_outputs):
         if "r" not in each_step_2_premise:
             continue
         tmp_A, tmp_B = 0, 0
-        for each_key in ["s", "o", "cp", "eb", "r"]:
+        for each_key in _keys:
             if step_1_result[each_key] == each_step_2_premise[each_key]:
                 tmp_A += 5
             tmp_B += 5
@@ -93,7 +137,7 @@ def grade_0(json_outputs):
 
     a, b = 0, 0
     scores = A / (B + 1e-5)
-    row_idx, col_idx = linear_sum_assignment(-scores)
+    row_idx, col_idx = assign(scores)
     for row_i, col_i in zip(row_idx, col_idx):
         a += A[row_i, col_i]
         b += B[row_i, col_i]
@@ -103,14 +147,48 @@ def grade_0(json_outputs):
     return ret
 
 
-def grade_0_util(json_output):
-    # grade individual single step reasoning
+class DerivationCache:
+    # bounded lru cache of the conclusions derived from a premise pair, with the counters of hits and evictions
 
-    premise_1, premise_2, results = parsing_json(json_output)
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
 
-    if premise_1 is None or premise_2 is None or not results:
-        return 0.1
+    @staticmethod
+    def key(premise_1, premise_2):
+        # canonical premise pair, the values are typed so that the premises equal only in value (e.g., 1 and True)
+        # are not mixed up, eb is a set in the task
+        return tuple((type(each[k]).__name__, each[k]) for each in (premise_1, premise_2) for k in ("s", "o", "cp"))\
+            + tuple((type(each[k]).__name__, each[k]) for each in (premise_1, premise_2) for k in ("f", "c")) \
+            + tuple(tuple(sorted((type(each_eb).__name__, each_eb) for each_eb in set(each["eb"])))
+                    for each in (premise_1, premise_2))
 
+    def get(self, key):
+        ret = self.cache.get(key)
+        if ret is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return ret
+
+    def put(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.,
+                "evictions": self.evictions, "size": len(self.cache)}
+
+
+derivation_cache = DerivationCache()
+
+
+def _derive_labels(premise_1, premise_2):
     J1 = Task(premise_1["s"],
               premise_1["o"],
               premise_1["cp"],
@@ -121,30 +199,57 @@ def grade_0_util(json_output):
               premise_2["cp"],
               Truth(premise_2["f"], premise_2["c"]),
               set(premise_2["eb"]))
-    Rs = reasoning(J1, J2)
+    return tuple(each.to_json() for each in reasoning(J1, J2))
+
+
+def derive_labels(premise_1, premise_2):
+    # json of the conclusions derived from the (json) premises, shared by the calls on the same premise pair (not to
+    # be modified)
+    try:
+        key = DerivationCache.key(premise_1, premise_2)
+        hash(key)
+    except Exception:  # malformed premises are derived without the cache, to raise as they would without it
+        return _derive_labels(premise_1, premise_2)
+
+    ret = derivation_cache.get(key)
+    if ret is None:
+        ret = _derive_labels(premise_1, premise_2)
+        derivation_cache.put(key, ret)
+    return ret
+
+
+def grade_0_util(json_output):
+    # grade individual single step reasoning
+
+    premise_1, premise_2, results = parsing_json(json_output)
+
+    if premise_1 is None or premise_2 is None or not results:
+        return 0.1
+
+    Rs = derive_labels(premise_1, premise_2)
 
     A, B = np.zeros((len(results), len(Rs))), np.zeros((len(results), len(Rs)))
 
     for i, each_llm_output in enumerate(results):
         for j, each_label_task in enumerate(Rs):
             tmp_A, tmp_B = 0, 0
-            for each_key in ["s", "o", "cp", "eb", "r"]:
+            for each_key in _keys:
                 if each_llm_output is not None and each_key in each_llm_output and each_llm_output[each_key] == \
-                        each_label_task.to_json()[each_key]:
+                        each_label_task[each_key]:
                     tmp_A += 5
                 tmp_B += 5
 
             # grade on the truth-value
             if "f" in each_llm_output and "c" in each_llm_output:
-                tmp_A += fc_similarity_score(each_llm_output["f"], each_label_task.to_json()["f"]) * 25
-                tmp_A += fc_similarity_score(each_llm_output["c"], each_label_task.to_json()["c"]) * 25
+                tmp_A += fc_similarity_score(each_llm_output["f"], each_label_task["f"]) * 25
+                tmp_A += fc_similarity_score(each_llm_output["c"], each_label_task["c"]) * 25
             tmp_B += 50
             A[i, j] = tmp_A
             B[i, j] = tmp_B
 
     a, b = 0, 0
     scores = A / B
-    row_idx, col_idx = linear_sum_assignment(-scores)
+    row_idx, col_idx = assign(scores)
     for row_i, col_i in zip(row_idx, col_idx):
         a += A[row_i, col_i]
         b += B[row_i, col_i]
@@ -169,7 +274,7 @@ def grade_1(llm_json_output_step2, label_json_output_step2):
     for i, each_llm_output in enumerate(results_llm):
         for j, each_label in enumerate(results_label):
             tmp_A, tmp_B = 0, 0
-            for each_key in ["s", "o", "cp", "eb", "r"]:
+            for each_key in _keys:
                 if (each_llm_output is not None and each_key in each_llm_output and each_llm_output[each_key]
                         == each_label[each_key]):
                     tmp_A += 5
@@ -185,7 +290,7 @@ def grade_1(llm_json_output_step2, label_json_output_step2):
 
     a, b = 0, 0
     scores = A / B
-    row_idx, col_idx = linear_sum_assignment(-scores)
+    row_idx, col_idx = assign(scores)
     for row_i, col_i in zip(row_idx, col_idx):
         a += A[row_i, col_i]
         b += B[row_i, col_i]
@@ -193,8 +298,318 @@ def grade_1(llm_json_output_step2, label_json_output_step2):
     return float(max(0.1, a / (b + 1e-5)))
 
 
+class GradingBatch:
+    # the assignment problems of many records, graded together
+    # every (row, col) pair is reduced to its number of matched keys and its f/c values, so the pair scores of all the
+    # problems are computed at once with numpy, then the problems of the same tiny shape are solved at once by
+    # enumerating their assignments
+
+    def __init__(self):
+        self.problems = []  # (rows, cols, eps, offset)
+        self.pairs = []  # (valid, matched keys, has f/c, f_1, f_2, c_1, c_2, fixed fc score of f, of c)
+
+    def pair(self, valid=True, matches=0, has_fc=False, f_1=0., f_2=0., c_1=0., c_2=0.):
+        # values which are not plain numbers are scored right away by the scalar function (as the scalar grading)
+        fixed_f, fixed_c = np.nan, np.nan
+        if has_fc:
+            if not (isinstance(f_1, (int, float)) and isinstance(f_2, (int, float))):
+                fixed_f, f_1, f_2 = float(fc_similarity_score(f_1, f_2)), 0., 0.
+            if not (isinstance(c_1, (int, float)) and isinstance(c_2, (int, float))):
+                fixed_c, c_1, c_2 = float(fc_similarity_score(c_1, c_2)), 0., 0.
+        return valid, matches, has_fc, f_1, f_2, c_1, c_2, fixed_f, fixed_c
+
+    def add(self, pairs, rows, cols, eps=0.):
+        # pairs are in row-major order, return the index of the problem
+        self.problems.append((rows, cols, eps, len(self.pairs)))
+        self.pairs.extend(pairs)
+        return len(self.problems) - 1
+
+    def add_results(self, llm_outputs, labels):
+        # the problem of grade_0_util / grade_1, llm results x label results
+        pairs = []
+        for each_llm_output in llm_outputs:
+            for each_label in labels:
+                matches = sum(1 for each_key in _keys
+                              if each_llm_output is not None and each_key in each_llm_output
+                              and each_llm_output[each_key] == each_label[each_key])
+                if "f" in each_llm_output and "c" in each_llm_output:
+                    pairs.append(self.pair(True, matches, True, each_llm_output["f"], each_label["f"],
+                                           each_llm_output["c"], each_label["c"]))
+                else:
+                    pairs.append(self.pair(True, matches))
+        return self.add(pairs, len(llm_outputs), len(labels))
+
+    def add_link(self, step_1_result, step_2_premises):
+        # the problem of the connection between 2 steps in grade_0
+        pairs = []
+        for each_step_2_premise in step_2_premises:
+            if "r" not in each_step_2_premise:
+                pairs.append(self.pair(False))
+                continue
+            matches = sum(1 for each_key in _keys if step_1_result[each_key] == each_step_2_premise[each_key])
+            pairs.append(self.pair(True, matches, True, step_1_result["f"], each_step_2_premise["f"],
+                                   step_1_result["c"], each_step_2_premise["c"]))
+        return self.add(pairs, 1, len(step_2_premises), 1e-5)
+
+    def add_step(self, json_output):
+        # grade_0_util, either its final value (0.1) or a problem index
+        premise_1, premise_2, results = parsing_json(json_output)
+
+        if premise_1 is None or premise_2 is None or not results:
+            return 0.1
+
+        return self.add_results(results, derive_labels(premise_1, premise_2))
+
+    def solve(self):
+        # max(0.1, a / (b + 1e-5)) of every problem, as the scalar grading functions
+        ret = np.full(len(self.problems), 0.1)
+        if not self.pairs:
+            return ret
+
+        valid, matches, has_fc, f_1, f_2, c_1, c_2, fixed_f, fixed_c = [np.array(each) for each in zip(*self.pairs)]
+        score_f = np.where(np.isnan(fixed_f), fc_similarity_scores(f_1, f_2), fixed_f)
+        score_c = np.where(np.isnan(fixed_c), fc_similarity_scores(c_1, c_2), fixed_c)
+        A = np.where(has_fc, matches * 5 + score_f * 25 + score_c * 25, matches * 5.)
+        A = np.where(valid, A, 0.)
+        B = np.where(valid, 75., 0.)
+
+        groups = {}
+        for i, (rows, cols, eps, offset) in enumerate(self.problems):
+            groups.setdefault((rows, cols, eps), []).append(i)
+
+        for (rows, cols, eps), indices in groups.items():
+            if rows == 0 or cols == 0:
+                continue
+            indices = np.array(indices)
+            offsets = np.array([self.problems[i][3] for i in indices])
+            if math.perm(max(rows, cols), min(rows, cols)) > 24:
+                # large problems are left to scipy
+                for i, offset in zip(indices, offsets):
+                    ret[i] = self.solve_one(A, B, offset, rows, cols, eps)
+                continue
+
+            A_g = A[offsets[:, None] + np.arange(rows * cols)].reshape(-1, rows, cols)
+            B_g = B[offsets[:, None] + np.arange(rows * cols)].reshape(-1, rows, cols)
+            scores = A_g / (B_g + eps)
+
+            totals, a_s, b_s = [], [], []
+            for pairs in assignments(rows, cols):
+                total, a, b = 0, 0, 0
+                for r, c in pairs:
+                    total = total + scores[:, r, c]
+                    a = a + A_g[:, r, c]
+                    b = b + B_g[:, r, c]
+                totals.append(total)
+                a_s.append(a)
+                b_s.append(b)
+            totals = np.array(totals)
+            best = np.argmax(totals, axis=0)
+            a = np.array(a_s)[best, np.arange(len(indices))]
+            b = np.array(b_s)[best, np.arange(len(indices))]
+            ret[indices] = np.maximum(0.1, a / (b + 1e-5))
+
+            if rows > 1:
+                # ties are left to scipy (see assign)
+                tied = np.sum(totals >= totals[best, np.arange(len(indices))] - 1e-9, axis=0) > 1
+                for i, offset in zip(indices[tied], offsets[tied]):
+                    ret[i] = self.solve_one(A, B, offset, rows, cols, eps)
+
+        return ret
+
+    @staticmethod
+    def solve_one(A, B, offset, rows, cols, eps):
+        A_i = A[offset:offset + rows * cols].reshape(rows, cols)
+        B_i = B[offset:offset + rows * cols].reshape(rows, cols)
+        row_idx, col_idx = linear_sum_assignment(-(A_i / (B_i + eps)))
+        a, b = 0, 0
+        for row_i, col_i in zip(row_idx, col_idx):
+            a += A_i[row_i, col_i]
+            b += B_i[row_i, col_i]
+        return max(0.1, a / (b + 1e-5))
+
+
+def prepare_step_1(batch: GradingBatch, json_outputs):
+    # the components of a response depending on its step 1 only, each value is either final or a problem index
+    return {"step 1": batch.add_step(json_outputs["step 1"]),
+            "result": json_outputs["step 1"]["results"][0]}
+
+
+def prepare_step_2(batch: GradingBatch, json_outputs, label_json_outputs):
+    # the components of a response depending on its step 2 (and the label) only
+    ret = {"step 2": batch.add_step(json_outputs["step 2"]),
+           "premises": [json_outputs["step 2"]["premise_1"], json_outputs["step 2"]["premise_2"]]}
+
+    _, _, results_llm = parsing_json(json_outputs["step 2"])
+    if not results_llm:
+        ret["answer"] = 0.1
+    else:
+        _, _, results_label = parsing_json(label_json_outputs["step 2"])
+        ret["answer"] = batch.add_results(results_llm, results_label)
+    return ret
+
+
+def prepare_record(batch: GradingBatch, json_outputs, label_json_outputs):
+    # add the problems of grade_0(json_outputs) * grade_1(json_outputs, label_json_outputs) to the batch
+    # return the components, each either a final value or a problem index
+    step_1 = prepare_step_1(batch, json_outputs)
+    step_2 = prepare_step_2(batch, json_outputs, label_json_outputs)
+    link = batch.add_link(step_1["result"], step_2["premises"])
+    return {"step 1": step_1["step 1"], "step 2": step_2["step 2"], "link": link, "answer": step_2["answer"]}
+
+
+PARSE_ERROR = "err"  # stands for the responses which could not be loaded as json
+
+
+def try_grade(response, function, *args):
+    # (result of function, None), or (None, kind of error) where the scalar grading would raise
+    # the kind is "parse" for unparsable responses and the exception name for grader crashes
+    if isinstance(response, str) and response == PARSE_ERROR:
+        return None, "parse"
+    try:
+        return function(*args), None
+    except Exception as e:
+        return None, type(e).__name__
+
+
+def component_values(values, components, key):
+    # values of a component over a list of prepared components, nan where None
+    return np.array([np.nan if each is None else
+                     each[key] if isinstance(each[key], float) else values[each[key]] for each in components])
+
+
+def grade_batch(responses, labels):
+    # grade_0(response) * grade_1(response, label) for all the records at once, numerically the same as the scalar
+    # functions, -1 for the records on which they raise (e.g., "err" for unparsable responses)
+    batch = GradingBatch()
+    components = [try_grade(each_response, prepare_record, batch, each_response, each_label)[0]
+                  for each_response, each_label in zip(responses, labels)]
+
+    values = batch.solve()
+
+    ret = (component_values(values, components, "step 1") * component_values(values, components, "step 2")
+           * component_values(values, components, "link") * component_values(values, components, "answer"))
+    return np.where(np.isnan(ret), -1., ret)
+
+
+def grade_combinations(records):
+    # records are [label, response of model 1, ..., response of model M]
+    # return a list of (M, M) score matrices, [i, j] is the grade of the step 1 of model i combined with the step 2 of
+    # model j (so the diagonal grades the responses themselves), -1 where the scalar grading would raise
+    # and a list of (M, M) error matrices, with the kind of error ("parse" or the exception name) or "" if graded
+    # the step 1 and step 2 components are graded once per model, only the link between the two steps is graded for
+    # each combination, then the matrix is assembled by outer products
+    batch = GradingBatch()
+    prepared = []
+    for each in records:
+        label, responses = each[0], each[1:]
+        steps_1 = [try_grade(each_response, prepare_step_1, batch, each_response) for each_response in responses]
+        steps_2 = [try_grade(each_response, prepare_step_2, batch, each_response, label)
+                   for each_response in responses]
+        links = [[(None, error_1 or error_2) if error_1 or error_2 else
+                  try_grade(None, batch.add_link, step_1["result"], step_2["premises"])
+                  for step_2, error_2 in steps_2] for step_1, error_1 in steps_1]
+        prepared.append((steps_1, steps_2, links))
+
+    values = batch.solve()
+
+    scores, errors = [], []
+    for steps_1, steps_2, links in prepared:
+        link = np.array([[np.nan if each is None else values[each] for each, _ in row] for row in links],
+                        dtype=np.float64).reshape(len(steps_1), len(steps_2))
+        matrix = (np.outer(component_values(values, [each for each, _ in steps_1], "step 1"),
+                           component_values(values, [each for each, _ in steps_2], "step 2"))
+                  * link * component_values(values, [each for each, _ in steps_2], "answer")[None, :])
+        scores.append(np.where(np.isnan(matrix), -1., matrix))
+        errors.append(np.array([[error or "" for _, error in row] for row in links], dtype=object)
+                      .reshape(len(steps_1), len(steps_2)))
+    return scores, errors
+
+
+def grade_combinations_parallel(records, workers=1, chunk_size=256):
+    # grade_combinations over chunks of records in a process pool, the results are in the order of the records
+    return parallel_chunks(grade_combinations, records, workers, chunk_size)
+
+
+def grade_pairs(pairs):
+    # pairs are (label, response giving the step 1, response giving the step 2)
+    # return the scores and the errors of the pairs, the same as the entries of grade_combinations
+    # the components of the responses shared by several pairs (the same objects) are graded once
+    batch = GradingBatch()
+    steps_1, steps_2, prepared = {}, {}, []
+    for label, response_1, response_2 in pairs:
+        if id(response_1) not in steps_1:
+            steps_1[id(response_1)] = try_grade(response_1, prepare_step_1, batch, response_1)
+        if (id(response_2), id(label)) not in steps_2:
+            steps_2[id(response_2), id(label)] = try_grade(response_2, prepare_step_2, batch, response_2, label)
+        (step_1, error_1), (step_2, error_2) = steps_1[id(response_1)], steps_2[id(response_2), id(label)]
+        link = (None, error_1 or error_2) if error_1 or error_2 else \
+            try_grade(None, batch.add_link, step_1["result"], step_2["premises"])
+        prepared.append((step_1, step_2, link))
+
+    values = batch.solve()
+
+    score = (component_values(values, [step_1 for step_1, _, _ in prepared], "step 1")
+             * component_values(values, [step_2 for _, step_2, _ in prepared], "step 2")
+             * np.array([np.nan if link is None else values[link] for _, _, (link, _) in prepared], dtype=np.float64)
+             * component_values(values, [step_2 for _, step_2, _ in prepared], "answer"))
+    return np.where(np.isnan(score), -1., score).tolist(), [error or "" for _, _, (_, error) in prepared]
+
+
+def parallel_chunks(function, items, workers=1, chunk_size=256):
+    # function over chunks of items in a process pool, the function returns a tuple of lists, which are concatenated
+    # in the order of the items
+    if workers <= 1 or len(items) <= chunk_size:
+        return function(items)
+
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(function, chunks))
+    return tuple([value for each in results for value in each[k]] for k in range(len(results[0])))
+
+
+def grade_combinations_cached(records, cache: GradeCache, workers=1, chunk_size=256):
+    # grade_combinations, with the grades of the (label, step 1 response, step 2 response) already in the cache read
+    # from it, only the unseen combinations are graded (then added to the cache)
+    keys = []
+    for each in records:
+        label, responses = each[0], each[1:]
+        keys.append([[grade_key(GRADER_VERSION, label, response_1, response_2) for response_2 in responses]
+                     for response_1 in responses])
+
+    cached = cache.get_many(key for each in keys for row in each for key in row)
+
+    pairs, pair_keys = [], {}
+    for each, each_keys in zip(records, keys):
+        label, responses = each[0], each[1:]
+        for response_1, row in zip(responses, each_keys):
+            for response_2, key in zip(responses, row):
+                if key not in cached and key not in pair_keys:
+                    pair_keys[key] = len(pairs)
+                    pairs.append((label, response_1, response_2))
+
+    num_models = len(records[0]) - 1 if records else 1
+    graded_scores, graded_errors = parallel_chunks(grade_pairs, pairs, workers, chunk_size * num_models ** 2)
+    graded = {key: (graded_scores[i], graded_errors[i]) for key, i in pair_keys.items()}
+    cache.put_many(graded)
+    cached.update(graded)
+
+    scores = [np.array([[cached[key][0] for key in row] for row in each], dtype=np.float64) for each in keys]
+    errors = [np.array([[cached[key][1] for key in row] for row in each], dtype=object) for each in keys]
+    return scores, errors
+
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes used for grading")
+    parser.add_argument("--chunk_size", type=int, default=256, help="Number of records graded per task of a worker")
+    parser.add_argument("--cache", type=str, default="grade_cache.sqlite", help="Path of the on-disk grade cache")
+    parser.add_argument("--cache_size", type=int, default=1_000_000, help="Maximum number of cached grades")
+    parser.add_argument("--no_cache", action="store_true", help="Regrade everything without reading the cache")
+
+    args = parser.parse_args()
+
     record = []
     for col, each_record in enumerate(os.listdir("./test_record/")):
         with open("./test_record/" + each_record) as f:
@@ -208,43 +623,28 @@ if __name__ == "__main__":
                 try:
                     record[row - 1].append(json.loads(each_line[1].split("Assistant: ")[-1].strip()))
                 except:
-                    record[row - 1].append("err")
-
-    for i in range(len(record)):
-        rebuilt_responses = []
-        tmp_1 = []
-        tmp_2 = []
-        for j in range(len(record[i])):
-            if j == 0:
-                continue
-            if record[i][j] == "err":
-                tmp_1.append("err")
-                tmp_2.append("err")
-            else:
-                tmp_1.append(record[i][j]["step 1"])
-                tmp_2.append(record[i][j]["step 2"])
-        for each_1 in tmp_1:
-            for each_2 in tmp_2:
-                if each_1 == "err" or each_2 == "err":
-                    rebuilt_responses.append("err")
-                else:
-                    rebuilt_responses.append({"step 1": each_1, "step 2": each_2})
-        record[i].extend(rebuilt_responses)
-
-    scores = []
-    for i in range(len(record)):
-        tmp = []
-        for j in range(len(record[i])):
+                    record[row - 1].append(PARSE_ERROR)
 
-            if j == 0:
-                continue
-            try:
-                tmp.append(grade_0(record[i][j]) * grade_1(record[i][j], record[i][0]))
-            except:
-                tmp.append(-1)
-        scores.append(tmp)
-
-    scores = np.array(scores)
+    if args.no_cache:
+        scores, errors = grade_combinations_parallel(record, args.workers, args.chunk_size)
+    else:
+        with GradeCache(args.cache, args.cache_size) as cache:
+            scores, errors = grade_combinations_cached(record, cache, args.workers, args.chunk_size)
+            print(f">- grade cache: {cache.stats()}")
+    if args.workers <= 1:  # the workers have caches of their own
+        print(f">- derivation cache: {derivation_cache.stats()}")
+
+    # the responses themselves, then every step 1 combined with every step 2 (row-major)
+    scores = np.array([np.concatenate([np.diag(each), each.ravel()]) for each in scores])
+    errors = np.array([np.concatenate([np.diag(each), each.ravel()]) for each in errors])
+
+    kinds, counts = np.unique(errors[errors != ""], return_counts=True)
+    print(f">- {scores.size} grades, errors: {dict(zip(kinds.tolist(), counts.tolist()))}")
+    with open("grade_errors.csv", "w", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["Record", "Column", "Error"])
+        for i, j in zip(*np.nonzero(errors != "")):
+            writer.writerow([i, j, errors[i, j]])
 
     c_0, c_1, c_2, c_h3, c_h = [], [], [], [], []
 
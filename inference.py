@@ -0,0 +1,238 @@
+import argparse
+import copy
+import csv
+import os
+
+import pandas as pd
+import torch
+from tqdm import tqdm
+from transformers import LogitsProcessorList, StoppingCriteriaList
+
+from constrained_decoding import AnswerConstraint, AnswerLogitsProcessor
+from json_stopping import JsonStoppingCriteria
+
+# the testing of rLLMFT.ipynb: the prompts of the test table are generated by batches of similar lengths, instead of
+# the batches of 16 prompts in the order of the table, the outputs are written in the order of the table
+
+TOKENIZER_LENGTH = 800
+
+USER_TAG = "User:"
+ASSISTANT_TAG = "Assistant:"
+
+
+def get_full_text(row, eos_token):
+    intro = row["Introduction"].strip()
+    premise = row["Premise"].strip()
+    question = row["Question"].strip()
+    answer = row["Answer"].strip()
+    return f"{intro}\n{USER_TAG} {premise} {question}\n{ASSISTANT_TAG} {answer}{eos_token}"
+
+
+def get_full_text_test(row):
+    intro = row["Introduction"].strip()
+    premise = row["Premise"].strip()
+    question = row["Question"].strip()
+    return f"{intro}\n{USER_TAG} {premise} {question}\n{ASSISTANT_TAG}"
+
+
+def new_tokens(length, max_length=TOKENIZER_LENGTH, max_new_tokens=None):
+    # number of tokens generated after a (padded) prompt of the length
+    ret = max_length - length
+    return ret if max_new_tokens is None else min(ret, max_new_tokens)
+
+
+def answer_cap(tokenizer, rows, margin=1.25):
+    # cap of the generated tokens for the rows of a table: their longest answer (eos included), with a margin
+    answers = [f" {each['Answer'].strip()}{tokenizer.eos_token}" for each in rows]
+    return int(margin * max(len(each) for each in tokenizer(answers, add_special_tokens=False)["input_ids"]))
+
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=None, max_length=TOKENIZER_LENGTH, max_new_tokens=None):
+    # indices of the prompts grouped into batches of similar lengths, the longest first
+    # a batch takes at most max_tokens tokens, i.e., (its longest prompt + the generated tokens) * its number of
+    # prompts, but a single prompt is always a batch
+    # without max_new_tokens, the generation goes up to max_length, so every batch takes max_tokens // max_length
+    # prompts whatever their lengths, the budget only follows the prompt lengths with a cap
+    ret, batch = [], []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if batch:
+            longest = lengths[batch[0]]
+            if ((len(batch) + 1) * (longest + new_tokens(longest, max_length, max_new_tokens)) > max_tokens
+                    or len(batch) == max_batch_size):
+                ret.append(batch)
+                batch = []
+        batch.append(i)
+    if batch:
+        ret.append(batch)
+    return ret
+
+
+def common_prefix_length(input_ids):
+    # number of leading tokens shared by all the prompts (the introduction), the last token of each prompt is left out
+    ret = min(len(each) for each in input_ids) - 1
+    first = input_ids[0]
+    for each in input_ids[1:]:
+        ret = next((i for i in range(ret) if each[i] != first[i]), ret)
+    return max(ret, 0)
+
+
+def prefix_cache(model, prefix, device="cpu"):
+    # kv cache of the prefix (token ids) as a single sequence
+    with torch.no_grad():
+        return model(input_ids=torch.tensor([prefix], device=device), use_cache=True).past_key_values
+
+
+def pad_after_prefix(input_ids, prefix_length, pad_token_id):
+    # the prompts sharing their first prefix_length tokens, padded between the prefix and the rest, so that the kv
+    # cache of the prefix is the same for all of them (the positions follow the attention mask, as with left padding)
+    width = max(len(each) for each in input_ids) - prefix_length
+    ids, mask = [], []
+    for each in input_ids:
+        num_pad = width - (len(each) - prefix_length)
+        ids.append(each[:prefix_length] + [pad_token_id] * num_pad + each[prefix_length:])
+        mask.append([1] * prefix_length + [0] * num_pad + [1] * (len(each) - prefix_length))
+    return {"input_ids": torch.tensor(ids), "attention_mask": torch.tensor(mask)}
+
+
+def generate(model, tokenizer, texts, max_tokens=16 * TOKENIZER_LENGTH, max_batch_size=None,
+             max_length=TOKENIZER_LENGTH, max_new_tokens=None, device="cpu", json_stop=True, stats=None,
+             constraint=None, prefix_reuse=True, **kwargs):
+    # greedy outputs (prompt included) of the texts, in their order
+    # the prompts are left padded (the padding is skipped in the outputs), the rest of kwargs goes to model.generate
+    # with json_stop, each sequence is stopped once its answer (json object) is closed, the token savings of each
+    # batch are appended to stats (a list)
+    # with a constraint (constrained_decoding.AnswerConstraint), only the answers of the schema are generated
+    # with prefix_reuse, the prefix shared by all the prompts is encoded once, its kv cache is copied into each batch
+    input_ids = tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+    prefix_length = common_prefix_length(input_ids) if prefix_reuse and input_ids else 0
+    cache = prefix_cache(model, input_ids[0][:prefix_length], device) if prefix_length else None
+    batches = token_budget_batches([len(each) for each in input_ids], max_tokens, max_batch_size, max_length,
+                                   max_new_tokens)
+
+    padding_side, tokenizer.padding_side = tokenizer.padding_side, "left"
+    ret = [None] * len(texts)
+    try:
+        with torch.no_grad():
+            for batch in tqdm(batches):
+                if cache is not None:
+                    inputs = pad_after_prefix([input_ids[i] for i in batch], prefix_length, tokenizer.pad_token_id)
+                else:
+                    inputs = tokenizer.pad({"input_ids": [input_ids[i] for i in batch]}, return_tensors="pt")
+                inputs = {k: v.to(device) for k, v in inputs.items()}
+                num_new_tokens = new_tokens(inputs["input_ids"].shape[1], max_length, max_new_tokens)
+                if num_new_tokens <= 0:  # truncated prompts
+                    generated = inputs["input_ids"]
+                else:
+                    stopping = JsonStoppingCriteria(tokenizer, inputs["input_ids"].shape[1]) if json_stop else None
+                    processors = [AnswerLogitsProcessor(constraint, inputs["input_ids"].shape[1])] if constraint else []
+                    batch_cache = None
+                    if cache is not None:
+                        batch_cache = copy.deepcopy(cache)
+                        batch_cache.batch_repeat_interleave(len(batch))
+                    generated = model.generate(
+                        **inputs,
+                        max_new_tokens=num_new_tokens,
+                        num_beams=1,
+                        do_sample=False,
+                        pad_token_id=tokenizer.pad_token_id,
+                        stopping_criteria=StoppingCriteriaList([stopping] if json_stop else []),
+                        logits_processor=LogitsProcessorList(processors),
+                        past_key_values=batch_cache,
+                        **kwargs
+                    )
+                    if json_stop and stats is not None:
+                        stats.append(stopping.savings(generated.shape[1] - inputs["input_ids"].shape[1],
+                                                      num_new_tokens))
+                for i, text in zip(batch, tokenizer.batch_decode(generated, skip_special_tokens=True)):
+                    ret[i] = text
+    finally:
+        tokenizer.padding_side = padding_side
+    return ret
+
+
+def write_test_record(path, labels, outputs):
+    with open(path, "w") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(["Label", "Output"])
+        for row in zip(labels, outputs):
+            writer.writerow(row)
+
+
+def run_test(model, tokenizer, model_index, num_models, test_path="./data/data_table_test.csv",
+             output_dir="./test_record", num_test=None, use_answer_cap=False, **kwargs):
+    # generate the outputs of the model on the test table, written to test_record_{model_index}_{num_models}.csv
+    # kwargs go to generate, the generation goes up to the length limit unless max_new_tokens is given
+    # with use_answer_cap, max_new_tokens is the answer_cap of the table by default (opt-in, since the answers longer
+    # than the cap are cut), so that the batches are budgeted with it
+    df_test = pd.read_csv(test_path,
+                          quotechar='"',
+                          doublequote=True)
+    if num_test is not None:
+        df_test = df_test[:num_test]
+    rows = df_test.to_dict("records")
+    if use_answer_cap and kwargs.get("max_new_tokens") is None:
+        kwargs["max_new_tokens"] = answer_cap(tokenizer, rows)
+        print(f">- at most {kwargs['max_new_tokens']} new tokens per prompt")
+
+    model.eval()
+    stats = []
+    outputs = generate(model, tokenizer, [get_full_text_test(each) for each in rows], stats=stats, **kwargs)
+    for i, each in enumerate(stats):
+        print(f">- batch {i}: {each['stopped']}/{each['sequences']} stopped at the end of the json, "
+              f"{each['generated']} tokens generated, {each['saved']} saved ({each['steps_saved']} steps)")
+    if stats:
+        print(f">- {sum(each['saved'] for each in stats)} tokens saved in total")
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"test_record_{model_index}_{num_models}.csv")
+    write_test_record(path, [get_full_text(each, tokenizer.eos_token) for each in rows], outputs)
+    return path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--model_name", type=str, default="Qwen/Qwen2.5-1.5B",
+                        help="Name or path of the (fine-tuned) model")
+    parser.add_argument("--tiny", action="store_true", help="Use a tiny randomly initialized model on cpu instead")
+    parser.add_argument("--model_index", type=int, default=0)
+    parser.add_argument("--num_models", type=int, default=3)
+    parser.add_argument("--test_path", type=str, default="./data/data_table_test.csv")
+    parser.add_argument("--output_dir", type=str, default="./test_record")
+    parser.add_argument("--num_test", type=int, default=None, help="Number of test prompts, all of them by default")
+    parser.add_argument("--max_tokens", type=int, default=16 * TOKENIZER_LENGTH,
+                        help="Token budget of each batch, (longest prompt + generated tokens) * batch size")
+    parser.add_argument("--max_batch_size", type=int, default=None)
+    parser.add_argument("--max_new_tokens", type=int, default=None,
+                        help="Maximum number of generated tokens, up to the length limit by default")
+    parser.add_argument("--answer_cap", action="store_true",
+                        help="Without --max_new_tokens, cap the generated tokens at 1.25 times the longest answer of "
+                             "the test table, to budget the batches with it")
+    parser.add_argument("--no_json_stop", action="store_true",
+                        help="Generate until eos or the length limit, even after the json answer is closed")
+    parser.add_argument("--no_prefix_reuse", action="store_true",
+                        help="Encode the shared introduction again in every prompt instead of reusing its kv cache")
+    parser.add_argument("--constrained", action="store_true",
+                        help="Only generate answers of the schema (json of the reasoning steps)")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+
+    args = parser.parse_args()
+
+    if args.tiny:  # the tokenizer is trained on the test table
+        from tiny_model import EOS_TOKEN, tiny_model, tiny_tokenizer
+        tokenizer = tiny_tokenizer([get_full_text(each, EOS_TOKEN) for each in
+                                    pd.read_csv(args.test_path, quotechar='"', doublequote=True).to_dict("records")])
+        model = tiny_model(tokenizer)
+    else:
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        model = AutoModelForCausalLM.from_pretrained(args.model_name)
+    tokenizer.model_max_length = TOKENIZER_LENGTH
+    model.to(args.device)
+    constraint = AnswerConstraint(tokenizer).precompute() if args.constrained else None
+
+    print(run_test(model, tokenizer, args.model_index, args.num_models, args.test_path, args.output_dir, args.num_test,
+                   args.answer_cap, max_tokens=args.max_tokens, max_batch_size=args.max_batch_size,
+                   max_new_tokens=args.max_new_tokens, device=args.device, json_stop=not args.no_json_stop,
+                   constraint=constraint, prefix_reuse=not args.no_prefix_reuse))
@@ -0,0 +1,68 @@
+import torch
+from transformers import StoppingCriteria
+
+# stopping criterion of the generation of the answers, {"step 1": ..., "step 2": ...}, each sequence of a batch is
+# stopped as soon as its top-level json object is closed, instead of running on until eos or the length limit
+
+
+class JsonStoppingCriteria(StoppingCriteria):
+    # the balance of the braces (outside the strings) is tracked incrementally over the generated tokens, the tokens
+    # of the (padded) prompt are skipped
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.position = prompt_length
+        self.texts = {}  # token id -> text
+        self.depth, self.in_string, self.escape, self.stops = None, None, None, None
+
+    def token_text(self, token_id):
+        ret = self.texts.get(token_id)
+        if ret is None:
+            ret = self.texts[token_id] = self.tokenizer.decode([token_id])
+        return ret
+
+    def feed(self, row, text):
+        # whether the object of the row is closed within the text
+        for ch in text:
+            if self.in_string[row]:
+                if self.escape[row]:
+                    self.escape[row] = False
+                elif ch == "\\":
+                    self.escape[row] = True
+                elif ch == '"':
+                    self.in_string[row] = False
+            elif ch == "{":
+                self.depth[row] += 1
+            elif self.depth[row] == 0:  # before the object
+                continue
+            elif ch == '"':
+                self.in_string[row] = True
+            elif ch == "}":
+                self.depth[row] -= 1
+                if self.depth[row] == 0:
+                    return True
+        return False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.stops is None:
+            batch_size = input_ids.shape[0]
+            self.depth, self.in_string, self.escape = [0] * batch_size, [False] * batch_size, [False] * batch_size
+            self.stops = [None] * batch_size  # number of tokens generated until the object is closed
+
+        for position in range(self.position, input_ids.shape[1]):
+            for row, token_id in enumerate(input_ids[:, position].tolist()):
+                if self.stops[row] is None and self.feed(row, self.token_text(token_id)):
+                    self.stops[row] = position - self.prompt_length + 1
+        self.position = input_ids.shape[1]
+
+        return torch.tensor([each is not None for each in self.stops], dtype=torch.bool, device=input_ids.device)
+
+    def savings(self, num_generated, max_new_tokens):
+        # tokens of the batch generated and saved, compared with generating max_new_tokens for each sequence
+        used = [num_generated if each is None else each for each in (self.stops or [])]
+        return {"stopped": sum(each is not None for each in (self.stops or [])),
+                "sequences": len(used),
+                "generated": sum(used),
+                "saved": len(used) * max_new_tokens - sum(used),
+                "steps_saved": max_new_tokens - num_generated}
@@ -0,0 +1,114 @@
+import argparse
+import json
+import random
+import re
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# local stand-in of the chat-completions endpoint for running repair_json.py offline, e.g.,
+#   python mock_chat_server.py --port 8000 --latency 0.2 --error-rate 0.1
+#   python repair_json.py --API-key none --base-url http://127.0.0.1:8000/v1 --concurrency 32
+# it answers the repair prompts with the broken json itself (or the json given by --repair), after a random latency,
+# with some failed requests (status 500), some broken answers and some hanging requests, the batch prompts get an
+# answer for each of their items
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--host", type=str, default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8000)
+parser.add_argument("--latency", type=float, default=0.1, help="Maximum latency of each answer in seconds")
+parser.add_argument("--error-rate", type=float, default=0., help="Ratio of the requests failed with status 500")
+parser.add_argument("--broken-rate", type=float, default=0., help="Ratio of the answers which are not json")
+parser.add_argument("--hang-rate", type=float, default=0., help="Ratio of the requests answered after --hang seconds")
+parser.add_argument("--hang", type=float, default=120.)
+parser.add_argument("--repair", type=str, default=None, help="Json file answered to every repair prompt")
+
+_pending = re.compile(r"To repair: (.*)\n\s*Please output only the repaired json string", re.DOTALL)
+_batch_item = re.compile(r"<<<(\d+)>>>\n(.*?)\n<<</\1>>>", re.DOTALL)
+
+
+def repair_answer(broken):
+    # the answer to a broken json, e.g., ': {"step 1": ...' -> '{"step 1": ...'
+    if args.repair is not None:
+        content = repair
+    else:
+        content = broken[broken.find("{"):] if "{" in broken else broken
+    if random.random() < args.broken_rate:
+        content = content[:len(content) // 2]
+    return content
+
+
+class Handler(BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    in_flight, max_in_flight, requests = 0, 0, 0
+
+    def do_POST(self):
+        with Handler.lock:
+            Handler.in_flight += 1
+            Handler.requests += 1
+            Handler.max_in_flight = max(Handler.max_in_flight, Handler.in_flight)
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(random.uniform(0, args.latency))
+            if random.random() < args.hang_rate:
+                time.sleep(args.hang)
+            if random.random() < args.error_rate:
+                self.send_error(500)
+                return
+
+            prompt = body["messages"][-1]["content"]
+            items = _batch_item.findall(prompt)
+            if items:  # batch prompt
+                content = "\n".join(f"<<<{i}>>>\n{repair_answer(each)}\n<<</{i}>>>" for i, each in items)
+            else:
+                match = _pending.search(prompt)
+                content = repair_answer(match.group(1) if match else "")
+
+            self.answer({"id": f"chatcmpl-{Handler.requests}",
+                         "object": "chat.completion",
+                         "created": int(time.time()),
+                         "model": body.get("model", ""),
+                         "choices": [{"index": 0,
+                                      "message": {"role": "assistant", "content": content},
+                                      "finish_reason": "stop"}],
+                         "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}})
+        except (BrokenPipeError, ConnectionResetError):  # the client gave up (e.g., timed out)
+            pass
+        finally:
+            with Handler.lock:
+                Handler.in_flight -= 1
+
+    def answer(self, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_):
+        pass
+
+
+def stop(*_):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+
+    args = parser.parse_args()
+    repair = None
+    if args.repair is not None:
+        with open(args.repair) as f:
+            repair = f.read().strip()
+
+    signal.signal(signal.SIGTERM, stop)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f">- serving on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f">- {Handler.requests} requests, at most {Handler.max_in_flight} in flight")
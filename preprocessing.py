@@ -0,0 +1,120 @@
+import torch
+
+from inference import ASSISTANT_TAG, TOKENIZER_LENGTH, get_full_text
+
+# preprocessing of the fine-tuning data: the rows are tokenized once by batches, the labels (the answer, from the
+# assistant tag on) are found with the offset mapping, and the samples are packed into sequences of a fixed length
+# the samples of a sequence are told apart by their position ids, which restart at 0 for each of them (without an
+# attention mask, transformers then restricts the attention of each token to its own sample), or by a block causal mask
+# where transformers cannot do it (see packed_collator)
+
+IGNORE_INDEX = -100
+
+
+def label_starts(tokenizer, texts, encodings, max_length=TOKENIZER_LENGTH):
+    # index of the first label token of each text, the first token ending after the start of the assistant tag
+    # (slow tokenizers have no offset mapping, the text before the tag is then tokenized on its own)
+    tags = [each.rfind(ASSISTANT_TAG) for each in texts]
+    if "offset_mapping" in encodings:
+        return [next((i for i, (_, end) in enumerate(offsets) if end > tag), len(offsets))
+                for offsets, tag in zip(encodings["offset_mapping"], tags)]
+    prefixes = tokenizer([text[:tag] for text, tag in zip(texts, tags)], truncation=True, max_length=max_length)
+    return [len(each) for each in prefixes["input_ids"]]
+
+
+def tokenize_rows(tokenizer, rows, max_length=TOKENIZER_LENGTH, batch_size=1000):
+    # [{"input_ids": [...], "labels": [...]}, ...] of the rows (dicts of the data table columns)
+    ret = []
+    for start in range(0, len(rows), batch_size):
+        texts = [get_full_text(each, tokenizer.eos_token) for each in rows[start:start + batch_size]]
+        encodings = tokenizer(texts, truncation=True, max_length=max_length,
+                              return_offsets_mapping=tokenizer.is_fast)
+        for input_ids, mask_start in zip(encodings["input_ids"], label_starts(tokenizer, texts, encodings,
+                                                                               max_length)):
+            ret.append({"input_ids": input_ids,
+                        "labels": [IGNORE_INDEX] * mask_start + input_ids[mask_start:]})
+    return ret
+
+
+def pack(samples, pad_token_id, pack_length=TOKENIZER_LENGTH):
+    # the samples packed into sequences of pack_length tokens (first fit, the longest first), each sequence is
+    # {"input_ids", "labels", "position_ids"}, padded at the end (the padding is not a label and has its own positions)
+    bins = []  # [free tokens, [sample indices]]
+    for i in sorted(range(len(samples)), key=lambda i: -len(samples[i]["input_ids"])):
+        length = len(samples[i]["input_ids"])
+        assert length <= pack_length, "a sample is longer than the packed sequences"
+        for each in bins:
+            if each[0] >= length:
+                each[0] -= length
+                each[1].append(i)
+                break
+        else:
+            bins.append([pack_length - length, [i]])
+
+    ret = []
+    for free, indices in bins:
+        input_ids, labels, position_ids = [], [], []
+        for i in indices:
+            input_ids += samples[i]["input_ids"]
+            labels += samples[i]["labels"]
+            position_ids += list(range(len(samples[i]["input_ids"])))
+        ret.append({"input_ids": input_ids + [pad_token_id] * free,
+                    "labels": labels + [IGNORE_INDEX] * free,
+                    "position_ids": position_ids + list(range(free))})
+    return ret
+
+
+def collate(features):
+    # batch of packed sequences (of the same length), without an attention mask, the data collator of the trainer
+    # use_cache=False goes with the batch to the forward: the samples of a sequence are only told apart by their
+    # position ids without a kv cache, whatever the config of the model
+    ret = {k: torch.tensor([each[k] for each in features]) for k in ("input_ids", "labels", "position_ids")}
+    ret["use_cache"] = False
+    return ret
+
+
+def packed_attention(model):
+    # whether transformers restricts the attention to the samples of the packed sequences from their position ids for
+    # the model: the flash attention kernels do it, the other implementations only with the packed sequence detection
+    # of masking_utils (recent versions), and if their masks are built by transformers (not the custom ones)
+    implementation = getattr(model.config, "_attn_implementation", None) or "eager"
+    if implementation.startswith("flash_attention"):
+        return True
+    try:
+        from transformers.masking_utils import ALL_MASK_ATTENTION_FUNCTIONS, find_packed_sequence_indices
+    except ImportError:
+        return False
+    return implementation in ALL_MASK_ATTENTION_FUNCTIONS
+
+
+def block_causal_mask(position_ids, dtype=torch.float32):
+    # 4d additive mask (batch, 1, length, length) of packed sequences, each token only attends to the previous tokens
+    # of its sample (a sample starts where the position ids restart at 0), in the form of the masks prepared by
+    # transformers
+    samples = (position_ids == 0).cumsum(-1)
+    length = position_ids.shape[-1]
+    causal = torch.ones(length, length, dtype=torch.bool, device=position_ids.device).tril()
+    allowed = (samples[:, :, None] == samples[:, None, :]) & causal
+    return torch.zeros(allowed.shape, dtype=dtype, device=position_ids.device) \
+        .masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+def packed_collator(model):
+    # the data collator of the packed sequences for the model: collate, with a block causal mask when transformers does
+    # not tell the samples apart by their position ids (older versions, custom attention implementations)
+    if packed_attention(model):
+        return collate
+
+    def collate_masked(features):
+        ret = collate(features)
+        ret["attention_mask"] = block_causal_mask(ret["position_ids"], model.dtype)
+        return ret
+
+    return collate_masked
+
+
+def packed_dataset(tokenizer, df, max_length=TOKENIZER_LENGTH, pack_length=TOKENIZER_LENGTH, batch_size=1000):
+    # datasets.Dataset of the packed sequences of a data table (pandas)
+    from datasets import Dataset
+    samples = tokenize_rows(tokenizer, df.to_dict("records"), max_length, batch_size)
+    return Dataset.from_list(pack(samples, tokenizer.pad_token_id, max(pack_length, max_length)))
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def repair_key(model, broken):
+    # content address of a repair
+    return hashlib.sha256(json.dumps([model, broken]).encode("utf-8")).hexdigest()
+
+
+class RepairCache:
+    # on-disk cache of the successful repairs, key -> repaired json string
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS repairs (key TEXT PRIMARY KEY, repaired TEXT, time REAL)")
+        self.connection.commit()
+        self.hits, self.misses = 0, 0
+
+    def get(self, key):
+        row = self.connection.execute("SELECT repaired FROM repairs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, repaired):
+        # committed right away, so that a repair paid for is never lost
+        self.connection.execute("INSERT OR REPLACE INTO repairs VALUES (?, ?, ?)", (key, repaired, time.time()))
+        self.connection.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Journal:
+    # append-only record of the finished rows of an output file, one json line {"row": index, "line": [...]} per row,
+    # flushed as soon as the row is finished, so that an interrupted run resumes from it
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+
+    def load(self):
+        # {index: row} of the rows finished by the previous runs, a partly written last line is ignored
+        ret = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for each in f:
+                    try:
+                        each = json.loads(each)
+                    except ValueError:
+                        continue
+                    ret[each["row"]] = each["line"]
+        return ret
+
+    def write(self, index, line):
+        if self.f is None:
+            self.f = open(self.path, "a")
+        self.f.write(json.dumps({"row": index, "line": line}) + "\n")
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,69 +1,369 @@
 import argparse
+import asyncio
 import csv
 import json
 import os
+import random
+import re
 
 import pandas as pd
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from tqdm import tqdm
 
-from grading import grade_0
+from grading import grade_0, parsing_json
+from local_repair import repair
+from repair_cache import Journal, RepairCache, repair_key
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--API-key", type=str)
-parser.add_argument("--show-grade", type=bool, default=True)
+parser.add_argument("--show-grade", action="store_true", help="Print the grade of each repaired json")
+parser.add_argument("--base-url", type=str, default="https://api.deepseek.com")
+parser.add_argument("--model", type=str, default="deepseek-chat")
+parser.add_argument("--concurrency", type=int, default=0,
+                    help="Number of concurrent requests in the asyncio mode, 0 for the sequential requests")
+parser.add_argument("--timeout", type=float, default=60., help="Timeout of each request in seconds (asyncio mode)")
+parser.add_argument("--retries", type=int, default=5, help="Number of retries of each row")
+parser.add_argument("--backoff", type=float, default=1.,
+                    help="Base delay of the exponential backoff between the retries in seconds (asyncio mode)")
+parser.add_argument("--max-backoff", type=float, default=30., help="Maximum delay between the retries in seconds")
+parser.add_argument("--batch-size", type=int, default=1,
+                    help="Number of rows packed into each request, the batches are sent in the asyncio mode (with at "
+                         "least 1 concurrent request)")
+parser.add_argument("--no-local", action="store_true", help="Send every row to the llm, without the local repair")
+parser.add_argument("--cache", type=str, default="repair_cache.sqlite", help="Path of the on-disk cache of the repairs")
+
+
+def repair_prompt(pending_json_r):
+    return f"""The following string is a broken json, you need to repair it. 
+                    It uses "step 1" and "step 2" as two keys, in which the corresponding values are also json strings.
+                    To repair: {pending_json_r}
+                    Please output only the repaired json string. Do not explain anything.
+                    """
+
+
+def repair_request(pending_json_r, model):
+    return {"model": model,
+            "messages": [
+                {"role": "user", "content": repair_prompt(pending_json_r)}
+            ],
+            "temperature": 0.,
+            "max_tokens": 700,
+            "stream": False}
+
+
+def batch_prompt(pending_jsons):
+    items = "\n".join(f"<<<{i}>>>\n{each}\n<<</{i}>>>" for i, each in enumerate(pending_jsons))
+    return f"""The following strings are {len(pending_jsons)} broken jsons, you need to repair each of them. 
+                    Each one is between <<<i>>> and <<</i>>>, where i is its index.
+                    Each uses "step 1" and "step 2" as two keys, in which the corresponding values are also json strings.
+                    To repair:
+{items}
+                    Please output only the repaired json strings, each one between <<<i>>> and <<</i>>> as well.
+                    Do not explain anything.
+                    """
+
+
+def batch_request(pending_jsons, model):
+    return {"model": model,
+            "messages": [
+                {"role": "user", "content": batch_prompt(pending_jsons)}
+            ],
+            "temperature": 0.,
+            "max_tokens": min(8192, 700 * len(pending_jsons)),
+            "stream": False}
+
+
+_batch_item = re.compile(r"<<<(\d+)>>>(.*?)<<</\1>>>", re.DOTALL)
+
+
+def split_batch(content, size):
+    # {index: repaired json} of the items in the answer to a batch_prompt
+    return {int(i): each.strip() for i, each in _batch_item.findall(content) if int(i) < size}
+
+
+def check_schema(repaired_jsons):
+    # raise if the repaired json is still broken, or a step cannot be parsed by the grading or has no results (cut
+    # before them), whether the grade is shown or not
+    repaired = json.loads(repaired_jsons)
+    for each in ("step 1", "step 2"):
+        parsed = parsing_json(repaired[each])
+        if parsed is None or parsed[0] is None or not parsed[2]:
+            raise ValueError(f"invalid {each}")
+
+
+def cached_repair(cache, key):
+    # the repair of the cache, if any and accepted by check_schema (the cache may hold repairs of older versions only
+    # checked with json.loads)
+    repaired_jsons = cache.get(key) if cache is not None else None
+    try:
+        check_schema(repaired_jsons)
+    except Exception:
+        return None
+    return repaired_jsons
+
+
+def show_grade(repaired_jsons, args):
+    # display only, the repaired json is already checked
+    if args.show_grade:
+        print(grade_0(json.loads(repaired_jsons)))
+
+
+def repair_rows(client, rows, args, cache=None, on_done=None):
+    # rows (without the title) repaired one by one, the rows which cannot be repaired are kept
+    # the repairs are looked up in and added to the cache, on_done(i, row) is called as soon as the row i is finished
+    ret = []
+    for i, each_line in enumerate(tqdm(rows, desc="Processing Each Test Record")):
+        try:
+            prefix, pending_json_r = each_line[1].split("\nAssistant")
+            key = repair_key(args.model, pending_json_r)
+            repaired_jsons = cached_repair(cache, key)
+            if repaired_jsons is not None:
+                ret.append([each_line[0], prefix + "\nAssistant: " + repaired_jsons])
+            count = 0
+            while repaired_jsons is None:
+                response = client.chat.completions.create(**repair_request(pending_json_r, args.model))
+                repaired_jsons = response.choices[0].message.content.strip()
+                try:
+                    check_schema(repaired_jsons)
+                    show_grade(repaired_jsons, args)
+                    ret.append([each_line[0], prefix + "\nAssistant: " + repaired_jsons])
+                    if cache is not None:
+                        cache.put(key, repaired_jsons)
+                    break
+                except:
+                    repaired_jsons = None
+                    count += 1
+                    if count > args.retries:
+                        ret.append(each_line)
+                        break
+        except:
+            ret.append(each_line)
+        if on_done is not None:
+            on_done(i, ret[-1])
+    return ret
+
+
+def repair_rows_locally(rows, args):
+    # the rows which are valid or repaired without the llm (None for the others), and the number of rows of each kind,
+    # all of them accepted by check_schema as the repairs of the llm
+    ret, counts = [], {"valid": 0, "local": 0}
+    for each_line in rows:
+        try:
+            prefix, pending_json_r = each_line[1].split("\nAssistant")
+        except:
+            ret.append(None)
+            continue
+
+        try:
+            check_schema(pending_json_r.strip().removeprefix(":"))
+            counts["valid"] += 1
+            ret.append(each_line)
+            continue
+        except Exception:
+            pass
+
+        repaired_jsons = repair(pending_json_r)
+        try:
+            check_schema(repaired_jsons)
+        except:
+            ret.append(None)
+            continue
+        show_grade(repaired_jsons, args)
+        counts["local"] += 1
+        ret.append([each_line[0], prefix + "\nAssistant: " + repaired_jsons])
+    return ret, counts
+
+
+async def repair_one(client, semaphore, pending_json_r, args):
+    # the repaired json, or None after the retries, each attempt holds a slot of the semaphore
+    # failed requests (errors and timeouts included) and broken repairs are retried after an exponential backoff with
+    # full jitter
+    for attempt in range(args.retries + 1):
+        async with semaphore:
+            try:
+                response = await asyncio.wait_for(
+                    client.chat.completions.create(**repair_request(pending_json_r, args.model)), args.timeout)
+                repaired_jsons = response.choices[0].message.content.strip()
+                check_schema(repaired_jsons)
+                show_grade(repaired_jsons, args)
+                return repaired_jsons
+            except Exception:
+                pass
+        if attempt < args.retries:
+            await asyncio.sleep(random.uniform(0, min(args.max_backoff, args.backoff * 2 ** attempt)))
+    return None
+
+
+async def repair_rows_async(client, rows, args, cache=None, on_done=None):
+    # repair_rows with at most args.concurrency requests in flight, the rows are returned in their original order
+    # the rows with the same broken json share a single repair (the cache only has it once the repair is finished)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    progress = tqdm(total=len(rows), desc="Processing Each Test Record")
+    in_flight = {}  # key -> task of the repair
+
+    async def repair_once(key, pending_json_r):
+        repaired_jsons = await repair_one(client, semaphore, pending_json_r, args)
+        if repaired_jsons is not None and cache is not None:
+            cache.put(key, repaired_jsons)
+        return repaired_jsons
+
+    async def repair_line(each_line):
+        try:
+            prefix, pending_json_r = each_line[1].split("\nAssistant")
+        except (IndexError, ValueError):
+            return each_line
+        key = repair_key(args.model, pending_json_r)
+        repaired_jsons = cached_repair(cache, key)
+        if repaired_jsons is None:
+            if key not in in_flight:
+                in_flight[key] = asyncio.ensure_future(repair_once(key, pending_json_r))
+            repaired_jsons = await in_flight[key]
+            if repaired_jsons is None:
+                return each_line
+        return [each_line[0], prefix + "\nAssistant: " + repaired_jsons]
+
+    async def finish_line(i, each_line):
+        ret = await repair_line(each_line)
+        progress.update(1)
+        if on_done is not None:
+            on_done(i, ret)
+        return ret
+
+    ret = await asyncio.gather(*[finish_line(i, each_line) for i, each_line in enumerate(rows)])
+    progress.close()
+    return ret
+
+
+async def repair_batch(client, semaphore, pending_jsons, args):
+    # {index: repaired json} of the items of one batch request which are valid, each item is checked on its own
+    async with semaphore:
+        try:
+            response = await asyncio.wait_for(
+                client.chat.completions.create(**batch_request(pending_jsons, args.model)), args.timeout)
+            content = response.choices[0].message.content
+        except Exception:
+            return {}
+
+    ret = {}
+    for i, repaired_jsons in split_batch(content, len(pending_jsons)).items():
+        try:
+            check_schema(repaired_jsons)
+        except Exception:
+            continue
+        show_grade(repaired_jsons, args)
+        ret[i] = repaired_jsons
+    return ret
+
+
+async def repair_rows_batched(client, rows, args, cache=None, on_done=None):
+    # repair_rows_async with args.batch_size rows packed into each request, the rows with the same broken json are
+    # sent as a single item
+    # the rows which are still broken are packed into new batches of the next round, after a backoff, until the retries
+    # are used up
+    semaphore = asyncio.Semaphore(max(1, args.concurrency))
+    progress = tqdm(total=len(rows), desc="Processing Each Test Record")
+    ret = list(rows)
+
+    def finish(i, each_line):
+        ret[i] = each_line
+        progress.update(1)
+        if on_done is not None:
+            on_done(i, each_line)
+
+    pending = {}  # cache key -> (broken json, [(index, prefix), ...])
+    for i, each_line in enumerate(rows):
+        try:
+            prefix, pending_json_r = each_line[1].split("\nAssistant")
+        except (IndexError, ValueError):
+            finish(i, each_line)
+            continue
+        key = repair_key(args.model, pending_json_r)
+        repaired_jsons = cached_repair(cache, key)
+        if repaired_jsons is not None:
+            finish(i, [each_line[0], prefix + "\nAssistant: " + repaired_jsons])
+        else:
+            pending.setdefault(key, (pending_json_r, []))[1].append((i, prefix))
+
+    async def repair_keys(keys):
+        repaired = await repair_batch(client, semaphore, [pending[key][0] for key in keys], args)
+        for j, repaired_jsons in repaired.items():
+            _, lines = pending.pop(keys[j])
+            if cache is not None:
+                cache.put(keys[j], repaired_jsons)
+            for i, prefix in lines:
+                finish(i, [rows[i][0], prefix + "\nAssistant: " + repaired_jsons])
+
+    for attempt in range(args.retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            await asyncio.sleep(random.uniform(0, min(args.max_backoff, args.backoff * 2 ** (attempt - 1))))
+        keys = list(pending)
+        await asyncio.gather(*[repair_keys(keys[j:j + args.batch_size])
+                               for j in range(0, len(keys), args.batch_size)])
+
+    for _, lines in pending.values():
+        for i, _ in lines:
+            finish(i, rows[i])
+    progress.close()
+    return ret
+
 
 if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    client = OpenAI(
-        api_key=args.API_key,
-        base_url="https://api.deepseek.com"
-    )
-
+    cache = RepairCache(args.cache)
     for col, each_record in enumerate(os.listdir("./test_record/")):
         if "csv" not in each_record or "repaired" in each_record:
             continue
-        tmp = []
         with open("./test_record/" + each_record) as f:
             reader = csv.reader(f, quoting=csv.QUOTE_MINIMAL)
-            for row, each_line in tqdm(enumerate(reader), desc="Processing Each Test Record"):
-                if row == 0:  # skip the title
-                    tmp.append(each_line)
-                    continue
-                try:
-                    prefix, pending_json_r = each_line[1].split("\nAssistant")
-                    prompt = f"""The following string is a broken json, you need to repair it. 
-                    It uses "step 1" and "step 2" as two keys, in which the corresponding values are also json strings.
-                    To repair: {pending_json_r}
-                    Please output only the repaired json string. Do not explain anything.
-                    """
-                    count = 0
-                    while True:
-                        response = client.chat.completions.create(
-                            model="deepseek-chat",
-                            messages=[
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.,
-                            max_tokens=700,
-                            stream=False
-                        )
-                        repaired_jsons = response.choices[0].message.content.strip()
-                        try:
-                            json.loads(repaired_jsons)
-                            if args.show_grade:
-                                print(grade_0(json.loads(repaired_jsons)))
-                            tmp.append([each_line[0], prefix + "\nAssistant: " + repaired_jsons])
-                            break
-                        except:
-                            count += 1
-                            if count > 5:
-                                tmp.append(each_line)
-                                break
-                except:
-                    tmp.append(each_line)
+            tmp = list(reader)
+
+        # the rows finished before an interruption are taken from the journal, except the rows kept as they were
+        # (still broken after the retries, or valid, which the local step accepts again at no cost), retried instead
+        output_path = f"./test_record/repaired_{each_record}.csv"
+        journal = Journal(output_path + ".journal")
+        finished = {i: each for i, each in journal.load().items() if each != tmp[i + 1]}
+        todo = [i for i in range(len(tmp) - 1) if i not in finished]
+
+        if args.no_local:
+            local, counts = [None] * len(todo), {"valid": 0, "local": 0}
+        else:
+            local, counts = repair_rows_locally([tmp[i + 1] for i in todo], args)
+        for i, each_local in zip(todo, local):
+            if each_local is not None:
+                journal.write(i, each_local)
+                finished[i] = each_local
+        todo = [i for i, each_local in zip(todo, local) if each_local is None]
+        pending = [tmp[i + 1] for i in todo]
+
+        def on_done(i, each_line):
+            journal.write(todo[i], each_line)
+
+        if args.batch_size > 1:
+            client = AsyncOpenAI(api_key=args.API_key, base_url=args.base_url, max_retries=0, timeout=args.timeout)
+            repaired = asyncio.run(repair_rows_batched(client, pending, args, cache, on_done)) if pending else []
+        elif args.concurrency > 0:
+            client = AsyncOpenAI(api_key=args.API_key, base_url=args.base_url, max_retries=0, timeout=args.timeout)
+            repaired = asyncio.run(repair_rows_async(client, pending, args, cache, on_done)) if pending else []
+        else:
+            client = OpenAI(api_key=args.API_key, base_url=args.base_url)
+            repaired = repair_rows(client, pending, args, cache, on_done)
+        finished.update(zip(todo, repaired))
+
+        counts["resumed"] = len(tmp) - 1 - counts["valid"] - counts["local"] - len(pending)
+        counts["llm"] = sum(each_repaired is not each_line for each_repaired, each_line in zip(repaired, pending))
+        counts["broken"] = len(pending) - counts["llm"]
+        print(f">- {each_record}: {counts['resumed']} resumed, {counts['valid']} valid, {counts['local']} repaired "
+              f"locally, {counts['llm']} repaired by the llm, {counts['broken']} kept broken")
+
+        tmp = tmp[:1] + [finished[i] for i in range(len(tmp) - 1)]
 
         df = pd.DataFrame(tmp[1:], columns=tmp[0])
-        df.to_csv(f"./test_record/repaired_{each_record}.csv", index=False)
+        df.to_csv(output_path, index=False)
+        journal.remove()
+
+    print(f">- repair cache: {cache.stats()}")
+    cache.close()
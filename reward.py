@@ -0,0 +1,317 @@
+import argparse
+import http.client
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from grading import PARSE_ERROR, GradingBatch, component_values, prepare_record, try_grade
+from local_repair import repair as local_repair
+
+# the grading of grading.py as a reward of the rollouts in reinforcement fine-tuning: reward(prompts, completions,
+# labels) grades a whole batch at once (with GradingBatch), score = grade_0 * grade_1 as in grading.py, each
+# completion also gets the breakdown of its components (step 1, step 2, link between the steps, answer), the
+# completions which cannot be graded (not json, or crashing the grader) get the failure score
+# the service (python reward.py --port 8001, or --unix /tmp/reward.sock) grades the requests of concurrent clients
+# together, in micro-batches of at most --max_batch completions, waiting at most --max_wait seconds for them, e.g.,
+#   reward_function = RewardClient("http://127.0.0.1:8001")  # or RewardClient("unix:/tmp/reward.sock")
+#   scores = reward_function(prompts, completions, labels)
+
+_components = ("step 1", "step 2", "link", "answer")
+_task_types = {"s": str, "o": str, "cp": str, "f": (int, float), "c": (int, float), "eb": list}
+
+
+def answer_text(text):
+    # the answer of a generated text (or a full text of the tables), after the assistant tag and before eos
+    if isinstance(text, list):  # conversational format, [{"role": ..., "content": ...}, ...]
+        text = text[-1]["content"]
+    return text.split("Assistant: ")[-1].split("<|endoftext|>")[0].strip()
+
+
+def parse_completion(completion, repair=False):
+    # (json answer, "json"), (json answer, "repaired") with repair, or (PARSE_ERROR, "error")
+    text = answer_text(completion)
+    try:
+        return json.loads(text), "json"
+    except ValueError:
+        pass
+    if repair:
+        repaired = local_repair(text)
+        if repaired is not None:
+            return json.loads(repaired), "repaired"
+    return PARSE_ERROR, "error"
+
+
+def check_task(task, rule):
+    return (isinstance(task, dict) and all(isinstance(task.get(k), t) for k, t in _task_types.items())
+            and (not rule or isinstance(task.get("r"), str)))
+
+
+def check_label(label):
+    # raise a ValueError if the label is not an answer of the schema (that of grading.parsing_json, with at least a
+    # result per step and values of the right types), so that a bad request fails on its own
+    if not isinstance(label, dict):
+        raise ValueError("a label is not a json object")
+    for each in ("step 1", "step 2"):
+        step = label.get(each)
+        if not isinstance(step, dict) or not isinstance(step.get("results"), list) or not step["results"]:
+            raise ValueError(f"no results in the {each} of a label")
+        if not (check_task(step.get("premise_1"), False) and check_task(step.get("premise_2"), False)
+                and all(check_task(task, True) for task in step["results"])):
+            raise ValueError(f"invalid task in the {each} of a label")
+
+
+def parse_label(label):
+    # labels are json answers, or their texts (a ValueError is raised if they are not json, or not of the schema)
+    ret = label if isinstance(label, dict) else json.loads(answer_text(label))
+    check_label(ret)
+    return ret
+
+
+def reward(prompts, completions, labels, repair=False, failure=0.):
+    # (scores, breakdowns) of the completions, the prompts are not graded (they are part of the reward signature)
+    # the breakdown of a completion is {"score", "grade_0", "grade_1", "step 1", "step 2", "link", "answer", "parse",
+    # "error"}, with None for the components which could not be graded and the kind of error ("parse" or the
+    # exception name, "" if graded)
+    assert len(completions) == len(labels), "a label is needed for each completion"
+    batch = GradingBatch()
+    parsed = [parse_completion(each, repair) for each in completions]
+    prepared = [try_grade(answer, prepare_record, batch, answer, parse_label(label))
+                for (answer, _), label in zip(parsed, labels)]
+
+    values = batch.solve()
+
+    components = {key: component_values(values, [each for each, _ in prepared], key) for key in _components}
+    grade_0 = components["step 1"] * components["step 2"] * components["link"]
+    grade_1 = components["answer"]
+    score = grade_0 * grade_1
+
+    def value(x):
+        return None if np.isnan(x) else float(x)
+
+    scores, breakdowns = [], []
+    for i, ((_, parse), (_, error)) in enumerate(zip(parsed, prepared)):
+        scores.append(failure if np.isnan(score[i]) else float(score[i]))
+        breakdown = {"score": scores[-1], "grade_0": value(grade_0[i]), "grade_1": value(grade_1[i])}
+        breakdown.update({key: value(components[key][i]) for key in _components})
+        breakdown.update({"parse": parse, "error": error or ""})
+        breakdowns.append(breakdown)
+    return scores, breakdowns
+
+
+class Coalescer:
+    # the requests submitted by concurrent threads are graded together by a single thread, a micro-batch is started
+    # by the first pending request and takes the following ones for at most max_wait seconds, up to max_batch
+    # completions (a larger request is a batch of its own)
+
+    def __init__(self, max_batch=256, max_wait=0.005, **kwargs):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.kwargs = kwargs  # to reward
+        self.pending = queue.Queue()
+        self.carried = None  # the request which did not fit in the previous micro-batch
+        self.lock = threading.Lock()
+        self.batches, self.requests, self.completions, self.grading_time = 0, 0, 0, 0.
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def submit(self, prompts, completions, labels):
+        # (scores, breakdowns), blocking until graded
+        labels = [parse_label(each) for each in labels]  # the bad requests fail on their own
+        prompts = prompts or [None] * len(completions)
+        if len(completions) != len(labels):
+            raise ValueError("a label is needed for each completion")
+        future = Future()
+        self.pending.put((prompts, completions, labels, future))
+        return future.result()
+
+    def collect(self):
+        items = [self.carried or self.pending.get()]
+        self.carried = None
+        size = len(items[0][1])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            try:
+                item = self.pending.get(timeout=max(0., deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if size + len(item[1]) > self.max_batch:
+                self.carried = item  # first of the next micro-batch
+                break
+            items.append(item)
+            size += len(item[1])
+        return items
+
+    def grade(self, items):
+        # grade the requests together, and set their results
+        scores, breakdowns = reward([p for each in items for p in each[0]],
+                                    [c for each in items for c in each[1]],
+                                    [label for each in items for label in each[2]], **self.kwargs)
+        offset = 0
+        for _, completions, _, future in items:
+            future.set_result((scores[offset:offset + len(completions)],
+                               breakdowns[offset:offset + len(completions)]))
+            offset += len(completions)
+
+    def loop(self):
+        while True:
+            items = self.collect()
+            start = time.perf_counter()
+            try:
+                self.grade(items)
+            except Exception as e:
+                if len(items) == 1:
+                    items[0][3].set_exception(e)
+                else:  # a request broke the micro-batch, the requests are graded one by one so that only it fails
+                    for each in items:
+                        try:
+                            self.grade([each])
+                        except Exception as each_e:
+                            each[3].set_exception(each_e)
+            with self.lock:
+                self.batches += 1
+                self.requests += len(items)
+                self.completions += sum(len(each[1]) for each in items)
+                self.grading_time += time.perf_counter() - start
+
+    def stats(self):
+        with self.lock:
+            return {"batches": self.batches, "requests": self.requests, "completions": self.completions,
+                    "grading_time": self.grading_time}
+
+
+class Handler(BaseHTTPRequestHandler):
+    # POST /reward {"prompts": [...], "completions": [...], "labels": [...]} -> {"scores": [...], "breakdowns": [...]}
+    # GET /stats
+    coalescer = None
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            scores, breakdowns = Handler.coalescer.submit(body.get("prompts"), body["completions"], body["labels"])
+        except (ValueError, KeyError, TypeError) as e:
+            self.answer({"error": f"{type(e).__name__}: {e}"}, 400)
+            return
+        self.answer({"scores": scores, "breakdowns": breakdowns})
+
+    def do_GET(self):
+        self.answer(Handler.coalescer.stats())
+
+    def answer(self, obj, status=200):
+        data = json.dumps(obj).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):  # the client gave up
+            pass
+
+    def log_message(self, *_):
+        pass
+
+
+class RewardHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the clients of the rollout workers connect at once
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class RewardClient:
+    # reward function backed by the service, address is "http://host:port" or "unix:/path/of/the/socket"
+    # a connection is opened per call, so that the client can be shared by threads
+
+    def __init__(self, address, timeout=600.):
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self):
+        if self.address.startswith("unix:"):
+            return UnixHTTPConnection(self.address[len("unix:"):], self.timeout)
+        host, port = self.address.split("://")[-1].rstrip("/").split(":")
+        return http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+
+    def request(self, prompts, completions, labels):
+        # (scores, breakdowns)
+        connection = self.connection()
+        try:
+            connection.request("POST", "/reward", json.dumps({"prompts": prompts, "completions": completions,
+                                                              "labels": labels}),
+                               {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            body = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise ValueError(body.get("error", f"status {response.status}"))
+        return body["scores"], body["breakdowns"]
+
+    def __call__(self, prompts, completions, labels, **kwargs):
+        # the scores only, as reward functions of rl trainers, the other kwargs (e.g., of the trainer) are ignored
+        return self.request(prompts, completions, labels)[0]
+
+
+def stop(*_):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--unix", type=str, default=None, help="Path of a unix socket to serve on instead of tcp")
+    parser.add_argument("--max_batch", type=int, default=256, help="Maximum number of completions per micro-batch")
+    parser.add_argument("--max_wait", type=float, default=0.005,
+                        help="Maximum time in seconds a micro-batch waits for more requests")
+    parser.add_argument("--repair", action="store_true", help="Repair the truncated completions locally")
+    parser.add_argument("--failure", type=float, default=0., help="Score of the completions which cannot be graded")
+
+    args = parser.parse_args()
+
+    Handler.coalescer = Coalescer(args.max_batch, args.max_wait, repair=args.repair, failure=args.failure)
+    signal.signal(signal.SIGTERM, stop)
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        server = UnixHTTPServer(args.unix, Handler)
+        print(f">- serving on unix:{args.unix}")
+    else:
+        server = RewardHTTPServer((args.host, args.port), Handler)
+        print(f">- serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix is not None and os.path.exists(args.unix):
+            os.remove(args.unix)
+    stats = Handler.coalescer.stats()
+    print(f">- {stats['requests']} requests, {stats['completions']} completions graded in {stats['batches']} "
+          f"micro-batches ({stats['grading_time']:.2f} s)")
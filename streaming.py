@@ -0,0 +1,65 @@
+from torch.utils.data import IterableDataset, get_worker_info
+
+from config import cs
+from data_gen import COLUMNS, generate_raw_prompt, model_cases, select_templates
+from formal_reasoning import iter_indexed_reasoning
+from inference import TOKENIZER_LENGTH
+from preprocessing import pack, tokenize_rows
+
+# training samples generated, rendered and tokenized on the fly (in the dataloader workers), without data tables
+# the samples are those of data_gen.py --indexed: sample i only depends on (random_seed, split, model_index, i), and
+# the cases of the model are those of data_gen.model_cases (as in all the modes), so the stream of a model never draws
+# from the cases of the others
+
+
+class ReasoningStream(IterableDataset):
+    # the samples start, start + 1, ... (num_samples of them per epoch, or without end if None) are dealt to the
+    # workers by chunks of chunk_size, each chunk is tokenized in one batch and optionally packed (see preprocessing)
+    # every sample has its own random stream, so there is nothing to seed per worker, and the workers never overlap
+
+    def __init__(self, tokenizer, model_index=0, num_models=1, for_testing=False, num_samples=None, start=0,
+                 random_seed=39, num_templates=10, num_categories=5, max_length=TOKENIZER_LENGTH, pack_length=None,
+                 chunk_size=64):
+        self.tokenizer = tokenizer
+        self.model_index = -1 if for_testing else model_index  # as for the test table of data_gen.py
+        self.num_models = num_models
+        self.for_testing = for_testing
+        self.num_samples = num_samples
+        self.start = start
+        self.random_seed = random_seed
+        self.templates = select_templates(random_seed, num_templates, num_categories)
+        self.cases = list(cs) if for_testing else model_cases(random_seed, model_index, num_models)
+        self.max_length = max_length
+        self.pack_length = pack_length
+        self.chunk_size = chunk_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # each epoch takes the next num_samples samples (called by the trainer), fresh data instead of a repetition
+        self.epoch = epoch
+
+    def chunks(self, worker, num_workers):
+        # [start, stop) of the chunks of the worker
+        start = self.start + self.epoch * (self.num_samples or 0)
+        stop = None if self.num_samples is None else start + self.num_samples
+        chunk_start = start + worker * self.chunk_size
+        while stop is None or chunk_start < stop:
+            chunk_stop = chunk_start + self.chunk_size
+            yield chunk_start, chunk_stop if stop is None else min(chunk_stop, stop)
+            chunk_start += num_workers * self.chunk_size
+
+    def rows(self, start, stop):
+        # the rows of samples [start, stop), as those of the data tables
+        samples = iter_indexed_reasoning(self.cases, start, stop, *self.templates, self.random_seed, self.model_index,
+                                         self.for_testing)
+        return [dict(zip(COLUMNS, generate_raw_prompt(*each))) for each in samples]
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        for start, stop in self.chunks(worker, num_workers):
+            samples = tokenize_rows(self.tokenizer, self.rows(start, stop), self.max_length, self.chunk_size)
+            if self.pack_length:
+                yield from pack(samples, self.tokenizer.pad_token_id, max(self.pack_length, self.max_length))
+            else:
+                yield from samples
@@ -0,0 +1,50 @@
+import json
+
+import pandas as pd
+
+from config import cs
+from data_gen import (gen_tables, gen_tables_indexed, gen_tables_parallel, merge_indexed, model_cases,
+                      select_templates, table_path)
+from formal_reasoning import Task, Truth, match_case
+
+SEED, NUM_DATA, NUM_MODELS = 39, 60, 3
+
+
+def task(task_json):
+    return Task(task_json["s"], task_json["o"], task_json["cp"], Truth(task_json["f"], task_json["c"]),
+                task_json["eb"])
+
+
+def table_cases(name):
+    # the cases used by the reasoning steps of a table
+    ret = set()
+    for answer in pd.read_csv(table_path(name))["Answer"]:
+        for step in json.loads(answer).values():
+            ret.add(match_case(task(step["premise_1"]), task(step["premise_2"]))[2])
+    return ret
+
+
+def test_modes_share_the_cases_of_each_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    templates = select_templates(SEED, 10, 5)
+    config = {"random_seed": SEED}
+    original = list(cs)
+
+    generators = {"serial": lambda: gen_tables(SEED, NUM_DATA, NUM_MODELS, templates, ["csv"], 100000),
+                  "parallel": lambda: gen_tables_parallel(SEED, NUM_DATA, NUM_MODELS, templates, ["csv"], 100000, 2),
+                  "indexed": lambda: (gen_tables_indexed(SEED, NUM_DATA, NUM_MODELS, templates, ["csv"], 20, 2, 0, 1,
+                                                         config),
+                                      merge_indexed(NUM_DATA, NUM_MODELS, ["csv"], 20, config))}
+    for mode, generate in generators.items():
+        generate()
+        for model_index in range(NUM_MODELS):
+            expected = set(model_cases(SEED, model_index, NUM_MODELS))
+            assert table_cases(f"{model_index}_{NUM_MODELS}") == expected, (mode, model_index)
+        # generating the test tables must not reorder config.cs, which model_cases splits
+        assert cs == original, mode
+
+
+def test_model_cases_split_all_the_cases():
+    splits = sum([model_cases(SEED, model_index, NUM_MODELS) for model_index in range(NUM_MODELS)], [])
+    assert sorted(splits) == sorted(cs)
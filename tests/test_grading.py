@@ -0,0 +1,66 @@
+import copy
+
+import numpy as np
+
+from config import cs
+from data_gen import select_templates
+from formal_reasoning import Generator
+from grading import PARSE_ERROR, grade_0, grade_1, grade_batch, grade_combinations
+
+
+def labels(n=6):
+    G = Generator(39)
+    return [{"step 1": results[0], "step 2": results[1]}
+            for _, _, results in G.iter_random_reasoning(list(cs), n, *select_templates(39, 10, 5), 0, 1, True, {})]
+
+
+def perturbations(label, other):
+    # responses to the label: right, partly wrong, of another question, broken (the grading raises) or unparsable
+    ret = [copy.deepcopy(label) for _ in range(9)]
+    ret[1]["step 2"]["results"][0]["f"] = round(1 - ret[1]["step 2"]["results"][0]["f"], 3)
+    ret[2]["step 1"]["results"][0]["s"], ret[2]["step 1"]["results"][0]["o"] = \
+        ret[2]["step 1"]["results"][0]["o"], ret[2]["step 1"]["results"][0]["s"]
+    ret[3]["step 2"]["results"][0]["r"] = "wrong rule"
+    ret[4]["step 1"]["premise_2"]["eb"] = ret[4]["step 1"]["premise_2"]["eb"][:-1] + [-1]
+    del ret[5]["step 2"]["results"][0]["cp"]
+    ret[6]["step 2"]["results"] = []
+    ret[7] = copy.deepcopy(other)
+    del ret[8]["step 2"]
+    return ret + [PARSE_ERROR]
+
+
+def scalar_grade(response, label, response_2=None):
+    # the per-record grading of the original script, -1 where it raises
+    # with response_2, the step 1 of the response is combined with the step 2 of response_2, as rebuilt by the script
+    if response_2 is not None:
+        if PARSE_ERROR in (response, response_2):
+            return -1
+        response = {"step 1": response.get("step 1"), "step 2": response_2.get("step 2")}
+    try:
+        return grade_0(response) * grade_1(response, label)
+    except Exception:
+        return -1
+
+
+def test_grade_batch_is_the_scalar_grading():
+    pairs = []
+    each_labels = labels()
+    for i, label in enumerate(each_labels):
+        pairs += [(response, label) for response in perturbations(label, each_labels[i - 1])]
+    scores = grade_batch([response for response, _ in pairs], [label for _, label in pairs])
+    expected = [scalar_grade(response, label) for response, label in pairs]
+    assert min(expected) == -1 and max(expected) > 0.99  # errors and right answers are both covered
+    np.testing.assert_allclose(scores, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_grade_combinations_is_the_scalar_grading():
+    each_labels = labels()
+    records = [[label] + perturbations(label, each_labels[i - 1])[k::3]
+               for i, label in enumerate(each_labels) for k in range(3)]
+    scores, errors = grade_combinations(records)
+    for record, matrix, error in zip(records, scores, errors):
+        label, responses = record[0], record[1:]
+        expected = [[scalar_grade(response_1, label, response_2) for response_2 in responses]
+                    for response_1 in responses]
+        np.testing.assert_allclose(matrix, expected, rtol=1e-9, atol=1e-12)
+        assert ((error != "") == (np.array(expected) == -1)).all()
@@ -0,0 +1,23 @@
+import json
+
+from config import cs
+from data_gen import select_templates
+from formal_reasoning import Generator
+from local_repair import repair
+from repair_json import check_schema
+
+
+def test_repairs_of_the_cut_labels_are_the_labels():
+    # every cut point of the labels is either left to the llm (None), or repaired into the label itself
+    G = Generator(39)
+    repaired = 0
+    for _, _, results in G.iter_random_reasoning(list(cs), 20, *select_templates(39, 10, 5), 0, 1, True, {}):
+        label = {"step 1": results[0], "step 2": results[1]}
+        text = json.dumps(label)
+        for n in range(1, len(text)):
+            each = repair(text[:n])
+            if each is not None:
+                check_schema(each)
+                assert json.loads(each) == label, text[:n]
+                repaired += 1
+    assert repaired > 0
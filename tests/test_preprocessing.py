@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from preprocessing import block_causal_mask, collate, pack, packed_collator
+from tiny_model import tiny_model, tiny_tokenizer
+
+TEXTS = ["premise one, question one", "a longer premise two, question two", "three"]
+
+
+@pytest.mark.parametrize("implementation", ["eager", "sdpa"])
+@pytest.mark.parametrize("masked", [False, True])
+def test_packed_samples_only_attend_to_themselves(implementation, masked):
+    # the logits of each sample of a packed sequence are those of the sample alone, with the position ids only or with
+    # the block causal mask of the fallback
+    tokenizer = tiny_tokenizer(TEXTS)
+    model = tiny_model(tokenizer)
+    model.config._attn_implementation = implementation
+    model.eval()
+    samples = [{"input_ids": ids, "labels": ids} for ids in tokenizer(TEXTS)["input_ids"]]
+    batch = collate(pack(samples, tokenizer.pad_token_id, 64))
+    if masked:
+        batch["attention_mask"] = block_causal_mask(batch["position_ids"])
+
+    with torch.no_grad():
+        packed = model(**{k: v for k, v in batch.items() if k != "labels"}).logits[0]
+        start = 0
+        for each in sorted(samples, key=lambda each: -len(each["input_ids"])):  # the order of pack
+            alone = model(input_ids=torch.tensor([each["input_ids"]]), use_cache=False).logits[0]
+            assert torch.allclose(packed[start:start + len(alone)], alone, atol=1e-5)
+            start += len(alone)
+
+
+def test_packed_collator_falls_back_to_the_mask():
+    tokenizer = tiny_tokenizer(TEXTS)
+    model = tiny_model(tokenizer)
+    assert packed_collator(model) is collate
+    model.config._attn_implementation = "custom"
+    features = pack([{"input_ids": ids, "labels": ids} for ids in tokenizer(TEXTS)["input_ids"]],
+                    tokenizer.pad_token_id, 64)
+    batch = packed_collator(model)(features)
+    assert batch["attention_mask"].shape == (1, 1, 64, 64)
+    assert torch.equal(batch["attention_mask"], block_causal_mask(batch["position_ids"], model.dtype))
@@ -0,0 +1,23 @@
+import pandas as pd
+
+from data_gen import COLUMNS, gen_tables_indexed, merge_indexed, select_templates, table_path
+from streaming import ReasoningStream
+
+SEED, NUM_DATA, NUM_MODELS = 39, 40, 3
+
+
+def test_stream_rows_are_those_of_the_indexed_tables(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    templates = select_templates(SEED, 10, 5)
+    config = {"random_seed": SEED}
+    gen_tables_indexed(SEED, NUM_DATA, NUM_MODELS, templates, ["csv"], 20, 1, 0, 1, config)
+    merge_indexed(NUM_DATA, NUM_MODELS, ["csv"], 20, config)
+
+    # the tokenizer is only used when iterating, not by rows()
+    streams = {f"{model_index}_{NUM_MODELS}": ReasoningStream(None, model_index, NUM_MODELS, random_seed=SEED)
+               for model_index in range(NUM_MODELS)}
+    streams["test"] = ReasoningStream(None, for_testing=True, random_seed=SEED)
+    for name, stream in streams.items():
+        table = pd.read_csv(table_path(name), keep_default_na=False)[COLUMNS]
+        assert table.to_dict("records") == stream.rows(0, NUM_DATA), name
@@ -0,0 +1,36 @@
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast, Qwen2Config, Qwen2ForCausalLM
+
+# tiny randomly initialized model of the qwen2 architecture with a byte-level tokenizer, built locally (without any
+# download), to run the fine-tuning and testing code on cpu
+
+EOS_TOKEN = "<|endoftext|>"
+
+
+def tiny_tokenizer(texts=None, vocab_size=1024):
+    # byte-level bpe trained on the texts (one token per byte without texts), plus the eos token (also used for
+    # padding, as in qwen2.5)
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size if texts is not None else 0, special_tokens=[EOS_TOKEN],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tokenizer.train_from_iterator(texts if texts is not None else [], trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token=EOS_TOKEN, pad_token=EOS_TOKEN)
+
+
+def tiny_model(tokenizer, seed=0, hidden_size=32, num_layers=2, max_length=1024):
+    torch.manual_seed(seed)
+    config = Qwen2Config(vocab_size=len(tokenizer),
+                         hidden_size=hidden_size,
+                         intermediate_size=2 * hidden_size,
+                         num_hidden_layers=num_layers,
+                         num_attention_heads=4,
+                         num_key_value_heads=2,
+                         max_position_embeddings=max_length,
+                         eos_token_id=tokenizer.eos_token_id,
+                         pad_token_id=tokenizer.pad_token_id,
+                         bos_token_id=None,
+                         tie_word_embeddings=True)
+    return Qwen2ForCausalLM(config)